@@ -0,0 +1,62 @@
+"""Measures commits per second as the number of concurrent writers grows.
+
+    python -m bench.contention [connection string] [seconds per step]
+
+Each writer commits small transactions to the state table in a loop, in its 
+own task and so its own session. "serialised" repeats each step behind one 
+process-wide lock, as RadioDatabase.transaction used to be. Defaults to a 
+SQLite file in the working directory, which serialises writes itself, so 
+point it at Postgres to see pooled connections scale.
+"""
+import asyncio
+import sys
+from contextlib import AsyncExitStack
+from time import perf_counter
+
+from sqlalchemy import delete, update
+
+from radio_db.db import RadioDatabase, State, StateKey
+
+WRITERS = [ 1, 2, 4, 8, 16, 32 ]
+
+
+async def writer(rdb: RadioDatabase, lock: asyncio.Lock | None, until: float) -> int:
+    commits = 0
+    async with rdb.session():
+        while perf_counter() < until:
+            async with AsyncExitStack() as stack:
+                if lock:
+                    await stack.enter_async_context(lock)
+                async with rdb.transaction():
+                    await rdb.exec(
+                        update(State)
+                        .where(State.key == StateKey.SpotifyAuth)
+                        .values(value=str(commits))
+                    )
+            commits += 1
+    return commits
+
+
+async def main(connection_string: str, seconds: float):
+    rdb = RadioDatabase(connection_string)
+    await rdb.create_all()
+    async with rdb.session():
+        async with rdb.transaction():
+            await rdb.exec(delete(State))
+            await rdb.add(State(key=StateKey.SpotifyAuth, value=''))
+
+    print('writers  concurrent  serialised  (commits/s)')
+    for n in WRITERS:
+        rates = []
+        for lock in [ None, asyncio.Lock() ]:
+            until = perf_counter() + seconds
+            commits = await asyncio.gather(*[ writer(rdb, lock, until) for _ in range(n) ])
+            rates.append(sum(commits) / seconds)
+        print(f'{n:7}  {rates[0]:10.0f}  {rates[1]:10.0f}')
+
+
+if __name__ == '__main__':
+    asyncio.run(main(
+        sys.argv[1] if len(sys.argv) > 1 else 'sqlite+aiosqlite:///bench.db',
+        float(sys.argv[2]) if len(sys.argv) > 2 else 5.0
+    ))
@@ -0,0 +1,66 @@
+"""Times M3u8._read_inf against the character-by-character parser it replaced,
+over the real-world #EXTINF lines in tests/test_stream.py.
+
+    python -m bench.extinf
+"""
+from itertools import takewhile
+from timeit import repeat
+from typing import Callable
+
+from radio_db.stream import M3u8
+from tests.test_stream import GOLDEN
+
+N = 20_000
+
+
+def reference_read_inf(tag_line: str):
+    """The previous parser, for comparison"""
+    tag_map: dict[str, str] = {}
+
+    chars = iter(tag_line)
+    pop = lambda: next(chars, None)
+    until: Callable[[str], str] = lambda c: ''.join(takewhile(lambda d: c != d, chars))
+
+    duration = float(until(','))
+
+    eol = False
+    while not eol:
+        key = until('=')
+        value = ''
+        escape = False
+        quote = False
+        while not eol:
+            c = pop()
+            if not c:
+                eol = True
+                break
+            if escape:
+                value += c
+                escape = False
+            elif c == '\\':
+                escape = True
+            elif quote:
+                if c == '"':
+                    quote = False
+                else:
+                    value += c
+            elif c == '"':
+                quote = True
+            elif c == ',':
+                break
+        tag_map[key] = value
+
+    return duration, tag_map
+
+
+def main():
+    m3u8 = M3u8('')
+    lines = [ line for line, _, _ in GOLDEN ]
+    new = min(repeat(lambda: [ m3u8._read_inf(line, '') for line in lines ], number=N // len(lines), repeat=5))
+    old = min(repeat(lambda: [ reference_read_inf(line) for line in lines ], number=N // len(lines), repeat=5))
+    print(f'tokenizer: {new / N * 1e6:.2f} µs per line')
+    print(f'previous:  {old / N * 1e6:.2f} µs per line ({old / new:.1f}x slower)')
+
+
+if __name__ == '__main__':
+    main()
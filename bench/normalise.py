@@ -0,0 +1,34 @@
+"""Times song normalisation and key hashing, the per-row cost of matching.
+
+    python -m bench.normalise
+"""
+import re
+from timeit import timeit
+
+from radio_db.config import FilterConfig
+from radio_db.songs import normalise, song_key
+
+SAMPLES = [
+    ('Fleetwood Mac', 'Dreams - 2004 Remaster'),
+    ('Lorde', 'Green Light'),
+    ('The Beatles', "Here Comes The Sun (Remastered 2009)"),
+    ('Beyoncé feat. JAY-Z', 'Crazy In Love'),
+    ('  Six60  ', 'Don\'t Forget Your Roots'),
+]
+FILTERS = FilterConfig(blank=re.compile(r'\(?(remaster(ed)?|\d{4})\)?'), ignore=re.compile(r'^the breeze'))
+N = 100_000
+
+
+def main():
+    for name, filters in [('no filters', None), ('filters', FILTERS)]:
+        def run():
+            for artist, title in SAMPLES:
+                normalised = normalise(artist, title, filters)
+                if normalised is not None:
+                    song_key(normalised)
+        seconds = timeit(run, number=N // len(SAMPLES))
+        print(f'{name}: {seconds / N * 1e6:.2f} µs per song')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,124 @@
+"""Loads synthetic plays into a scratch database and times the hot queries 
+with and without the indexes from the hot_query_indexes migration.
+
+    python -m bench.queries [connection string] [plays]
+
+Defaults to a SQLite file in the working directory and 2 million plays.
+The database is dropped and recreated, so don't point it at anything real.
+"""
+import asyncio
+import random
+import sys
+from datetime import datetime, timedelta
+from time import perf_counter
+
+from sqlalchemy import Index, and_, desc, func, insert, null, or_
+from sqlalchemy.ext.asyncio import AsyncEngine
+from sqlalchemy.future import select
+
+from radio_db.db import Base, Pending, Play, RadioDatabase, Song, Station
+
+INDEXES = [ Pending.__table__.indexes, Play.__table__.indexes ]
+
+STATIONS = 50
+SONGS = 20_000
+PENDING = 100_000
+CHUNK = 10_000
+RUNS = 20
+
+
+def _new_indexes() -> list[Index]:
+    return [ i for indexes in INDEXES for i in indexes if i.name in ('pending_claim_index', 'play_station_at_index') ]
+
+
+async def load(engine: AsyncEngine, plays: int):
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.drop_all)
+        await conn.run_sync(Base.metadata.create_all)
+        for index in _new_indexes():
+            await conn.run_sync(lambda c: index.drop(c))
+
+        now = datetime.now()
+        await conn.execute(insert(Station), [ dict(id=i, key=f's{i}', name=f'Station {i}', url='') for i in range(1, STATIONS + 1) ])
+        await conn.execute(insert(Song), [ 
+            dict(id=i, key=i, artist=f'Artist {i % 2000}', title=f'Title {i}', spotify_uri=f'spotify:track:{i}') 
+            for i in range(1, SONGS + 1) 
+        ])
+        for start in range(0, plays, CHUNK):
+            await conn.execute(insert(Play), [
+                dict(
+                    id=i + 1, 
+                    station=random.randint(1, STATIONS), 
+                    # A skewed distribution, so some songs are hits
+                    song=min(SONGS, int(random.paretovariate(1.2))), 
+                    at=now - timedelta(seconds=random.randint(0, 365 * 86400))
+                )
+                for i in range(start, min(plays, start + CHUNK))
+            ])
+        for start in range(0, PENDING, CHUNK):
+            await conn.execute(insert(Pending), [
+                dict(
+                    id=i + 1, 
+                    station=random.randint(1, STATIONS), 
+                    artist='a', 
+                    title='t', 
+                    seen_at=now - timedelta(seconds=random.randint(0, 86400)),
+                    picked_at=None if random.random() < 0.5 else now
+                )
+                for i in range(start, min(PENDING, start + CHUNK))
+            ])
+
+
+async def time_queries(rdb: RadioDatabase):
+    now = datetime.now()
+    queries = {
+        'pending claim': 
+            select(Pending.id)
+            .where(or_(Pending.picked_at == null(), Pending.picked_at <= now - timedelta(minutes=5)))
+            .order_by(Pending.seen_at)
+            .limit(25),
+        'top songs':
+            select(func.max(Play.at).label('last_played'), func.count().label('play_count'), Play.song)
+            .where(and_(Play.at > now - timedelta(days=7), Play.station == 1))
+            .group_by(Play.song)
+            .order_by(desc('play_count'), desc('last_played')),
+        'song lookup':
+            select(Song)
+            .where(or_(Song.spotify_uri == f'spotify:track:{SONGS // 2}', and_(Song.artist == 'Artist 1', Song.title == 'Title 1'))),
+    }
+    async with rdb.session():
+        for name, query in queries.items():
+            await rdb.exec(query)
+            start = perf_counter()
+            for _ in range(RUNS):
+                result = await rdb.exec(query)
+                result.all()
+            print(f'  {name}: {(perf_counter() - start) / RUNS * 1000:.2f} ms')
+
+
+async def main(connection_string: str, plays: int):
+    rdb = RadioDatabase(connection_string)
+    engine = rdb.create_engine()
+    print(f'Loading {plays} plays...')
+    start = perf_counter()
+    await load(engine, plays)
+    print(f'  took {perf_counter() - start:.0f}s')
+
+    print('Without indexes:')
+    await time_queries(rdb)
+
+    async with engine.begin() as conn:
+        for index in _new_indexes():
+            await conn.run_sync(lambda c: index.create(c))
+        if conn.dialect.name == 'postgresql':
+            await conn.exec_driver_sql('ANALYZE')
+
+    print('With indexes:')
+    await time_queries(rdb)
+
+
+if __name__ == '__main__':
+    asyncio.run(main(
+        sys.argv[1] if len(sys.argv) > 1 else 'sqlite+aiosqlite:///bench.db',
+        int(sys.argv[2]) if len(sys.argv) > 2 else 2_000_000
+    ))
@@ -4,15 +4,20 @@ import json
 import logging
 import sys
 from functools import wraps
+from pathlib import Path
+from time import time
+from typing import List
 
 import typer
 from spotipy import CacheHandler, Spotify, SpotifyOAuth
 from typer import Option
 
 from . import db, playlists
+from .catalog import BATCH_SIZE, import_catalog as import_catalog_rows, read_catalog
 from .config import from_yaml as config_from_yaml
 from .monitor import run as run_monitor
 from .manage import run as run_manage
+from .stations import rebuild_play_daily
 
 log = logging.getLogger('__name__')
 
@@ -45,14 +50,21 @@ async def monitor():
 
 @app.command()
 @run_sync
-async def update_playlists(station_key: str = typer.Argument(None)):
+async def update_playlists(
+    station_keys: List[str] = typer.Argument(None, help='Stations to update, default all'),
+    concurrency: int = Option(4, help='Stations updated at once'),
+):
     if not config:
         log.error('Config not loaded')
         return
 
-    for station in config.stations:
-        if not station_key or station.key == station_key:
-            await playlists.update(config, station.key)
+    start = time()
+    results = await playlists.update(config, station_keys, concurrency)
+    for station, seconds, error in sorted(results, key=lambda r: -r[1]):
+        print(f'{station.name:30} {seconds:6.1f}s {"failed: " + str(error) if error else "ok"}')
+    print(f'{len(results)} stations in {time() - start:.1f}s')
+    if any(error for _, _, error in results):
+        raise typer.Exit(1)
 
 @app.command()
 def authorise():
@@ -98,6 +110,38 @@ async def init_db():
     await rdb.create_all()
 
 
+@app.command()
+@run_sync
+async def backfill_play_daily():
+    """Rebuild the daily play count rollup from all plays."""
+    if not config:
+        log.error('Config not loaded')
+        return
+
+    rdb = db.RadioDatabase.from_config(config.database)
+    await rdb.connect()
+    await rebuild_play_daily(rdb)
+
+
+@app.command()
+@run_sync
+async def import_catalog(
+    catalog_file: Path,
+    batch_size: int = Option(BATCH_SIZE, help='Songs per INSERT'),
+):
+    """Pre-load songs from a CSV (artist,title,spotify_uri header) or JSON Lines file.
+    Songs already in the database are left as they are, and rows missing any of
+    the three are rejected."""
+    if not config:
+        log.error('Config not loaded')
+        return
+
+    rdb = db.RadioDatabase.from_config(config.database)
+    await rdb.connect()
+    inserted, skipped, rejected = await import_catalog_rows(rdb, read_catalog(catalog_file), batch_size)
+    print(f'Imported {inserted} songs, skipped {skipped} already known, rejected {rejected} without an artist, title or spotify_uri')
+
+
 @app.command()
 @run_sync
 async def manage():
@@ -0,0 +1,79 @@
+import csv
+import json
+import logging
+from pathlib import Path
+from time import time
+from typing import Any, Iterable, Iterator, List, Tuple
+
+from .db import RadioDatabase, Song
+from .songs import normalise, song_key
+
+log = logging.getLogger(__name__)
+
+# 4 parameters a row keeps each INSERT well under postgres' limit of 32767
+BATCH_SIZE = 1000
+
+
+def read_catalog(path: Path) -> Iterator[dict[str, Any]]:
+    """Rows of artist, title and spotify_uri from a CSV file with a header,
+    or JSON Lines if it isn't named .csv"""
+    with path.open(newline='', encoding='utf-8') as f:
+        if path.suffix.lower() == '.csv':
+            yield from csv.DictReader(f)
+        else:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def catalog_song(row: dict[str, Any]) -> dict[str, Any] | None:
+    """Song values for a row, keyed the same as seen songs, or None if it 
+    doesn't have everything a matched song needs"""
+    artist = (row.get('artist') or '').strip()
+    title = (row.get('title') or '').strip()
+    spotify_uri = (row.get('spotify_uri') or '').strip()
+    if not artist or not title or not spotify_uri:
+        return None
+    key, _ = song_key(normalise(artist, title)) # type: ignore
+    return dict(key=key, artist=artist, title=title, spotify_uri=spotify_uri)
+
+
+async def import_catalog(db: RadioDatabase, rows: Iterable[dict[str, Any]], batch_size: int = BATCH_SIZE) -> Tuple[int, int, int]:
+    """Insert songs in multi-row batches, skipping any that conflict with
+    existing songs on key, spotify_uri or artist and title.
+
+    Rows without an artist, title and spotify_uri are rejected, since a song 
+    is taken to be matched on spotify.
+
+    Returns the number inserted, skipped and rejected."""
+    inserted = 0
+    skipped = 0
+    rejected = 0
+    start = time()
+    # Executed with many rows, this is sent as multi-row INSERTs of the same
+    # SQL, so it's only compiled once
+    query = db.insert(Song).on_conflict_do_nothing().returning(Song.id)
+
+    async def write(batch: List[dict[str, Any]]):
+        nonlocal inserted, skipped
+        async with db.transaction():
+            added = len((await db.exec(query, batch)).all())
+        inserted += added
+        skipped += len(batch) - added
+        log.info(f'{inserted} songs imported, {skipped} skipped, {rejected} rejected ({inserted / (time() - start):.0f}/s)')
+
+    async with db.session():
+        batch: List[dict[str, Any]] = []
+        for row in rows:
+            song = catalog_song(row)
+            if not song:
+                log.debug(f'Rejected {row}')
+                rejected += 1
+                continue
+            batch.append(song)
+            if len(batch) >= batch_size:
+                await write(batch)
+                batch = []
+        if batch:
+            await write(batch)
+    return inserted, skipped, rejected
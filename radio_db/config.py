@@ -2,10 +2,17 @@ from pydantic import BaseModel, BaseSettings
 from enum import Enum
 from typing import Optional, Pattern, List
 from ruamel.yaml import YAML
+from os import getpid
+from socket import gethostname
 
 class PlaylistType(Enum):
     Top = 'top'
 
+class StreamParser(Enum):
+    M3u8 = 'm3u8'
+    Icy = 'icy'
+    RadioApi = 'radioapi'
+
 class FilterConfig(BaseModel):
     blank: Optional[Pattern] = None
     ignore: Optional[Pattern] = None
@@ -19,6 +26,8 @@ class StationConfig(BaseModel):
     key: str
     name: str
     url: str
+    # skips format detection
+    parser: Optional[StreamParser] = None
     filters: Optional[FilterConfig] = None
     playlists: List[PlaylistConfig] = []
 
@@ -38,10 +47,67 @@ class DatabaseConfig(BaseSettings):
         env_prefix = 'RDB_DATABASE_'
         env_file = '.env'
 
+class MonitorConfig(BaseSettings):
+    # number of pending rows claimed and written per transaction
+    batch_size: int = 25
+    # concurrent song matching tasks, and how many rows may wait between stages
+    matchers: int = 4
+    queue_size: int = 100
+    # recently matched songs kept in memory, by normalised key
+    song_cache_size: int = 10000
+    song_cache_seconds: int = 3600
+    # how long to remember that a search found nothing on spotify
+    search_miss_days: int = 7
+    # match songs spelled slightly differently to one already in the database, 
+    # without searching spotify, when at least this similar (0-1). Off by 
+    # default, as a wrong match is recorded against every later play
+    fuzzy_match: bool = False
+    fuzzy_threshold: float = 0.8
+    # songs held in memory to match against, starting with those played in the 
+    # last fuzzy_index_days, then the most recently matched
+    fuzzy_index_size: int = 50000
+    fuzzy_index_days: int = 90
+    # seen songs are written in batches of up to ingest_max_rows, at most 
+    # ingest_max_delay seconds after being seen (the most that can be lost)
+    ingest_max_rows: int = 100
+    ingest_max_delay: float = 5.0
+    # how often to check for pending rows written by other processes when the 
+    # database can't notify us of them (only postgres can)
+    pending_poll_seconds: float = 30
+    # share stations with other monitor instances using leases in the database
+    sharded: bool = False
+    node_name: str = f'{gethostname()}-{getpid()}'
+    lease_seconds: int = 60
+    # polling of stations that don't push changes: at most poll_concurrency 
+    # requests at once, each station adapting between poll_min_seconds and 
+    # poll_max_seconds to how often its songs change, +/- poll_jitter of that
+    poll_concurrency: int = 16
+    poll_min_seconds: float = 10
+    poll_max_seconds: float = 300
+    poll_initial_seconds: float = 60
+    poll_jitter: float = 0.1
+    # first polls are spread over this many seconds
+    poll_start_spread: float = 10
+    # rebuild a station's playlists in the monitor, playlist_debounce_seconds 
+    # after its first new play or once it has playlist_max_plays new plays
+    playlists: bool = False
+    playlist_debounce_seconds: float = 600
+    playlist_max_plays: int = 10
+    playlist_concurrency: int = 2
+    # serve prometheus metrics on http://metrics_host:metrics_port/metrics, 
+    # nothing is recorded if not set
+    metrics_port: Optional[int] = None
+    metrics_host: str = '127.0.0.1'
+
+    class Config:
+        env_prefix = 'RDB_MONITOR_'
+        env_file = '.env'
+
 class Config(BaseSettings):
     stations: List[StationConfig]
     database: DatabaseConfig = DatabaseConfig()
     spotify: SpotifyConfig = SpotifyConfig()
+    monitor: MonitorConfig = MonitorConfig()
 
     class Config:
         env_prefix = 'RDB_'
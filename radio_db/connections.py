@@ -0,0 +1,41 @@
+import aiohttp
+
+# Per-host limit keeps us polite to stream hosts serving many of our stations
+LIMIT = 100
+LIMIT_PER_HOST = 8
+DNS_CACHE_SECONDS = 300
+
+_http: aiohttp.ClientSession | None = None
+_streams: aiohttp.ClientSession | None = None
+
+
+def http_session() -> aiohttp.ClientSession:
+    """The process-wide HTTP session shared by all stream parsers, created on first use"""
+    global _http
+    if not _http or _http.closed:
+        _http = aiohttp.ClientSession(connector=aiohttp.TCPConnector(
+            limit=LIMIT,
+            limit_per_host=LIMIT_PER_HOST,
+            ttl_dns_cache=DNS_CACHE_SECONDS,
+        ))
+    return _http
+
+
+def stream_session() -> aiohttp.ClientSession:
+    """Session for connections held open for as long as a station is monitored (icy),
+    kept apart so they can't starve the polling parsers of connections"""
+    global _streams
+    if not _streams or _streams.closed:
+        _streams = aiohttp.ClientSession(connector=aiohttp.TCPConnector(
+            limit=0,
+            ttl_dns_cache=DNS_CACHE_SECONDS,
+        ))
+    return _streams
+
+
+async def close_http_session():
+    global _http, _streams
+    for session in (_http, _streams):
+        if session:
+            await session.close()
+    _http = _streams = None
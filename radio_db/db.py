@@ -1,24 +1,35 @@
 import asyncio
 import enum
 import logging
-from asyncio import Lock
 from contextlib import asynccontextmanager
 from contextvars import ContextVar
-from typing import AsyncGenerator, Type
+from time import perf_counter
+from typing import Any, AsyncGenerator, List, Tuple, Type
 from urllib.parse import quote_plus
 
-from sqlalchemy import BigInteger, Column, DateTime, Enum, String, create_engine
+from sqlalchemy import JSON, BigInteger, Column, Date, DateTime, Enum, String, Table, create_engine, event
+from sqlalchemy.dialects import postgresql, sqlite
 from sqlalchemy.ext.asyncio import (AsyncConnection, AsyncEngine, AsyncSession,
                                     create_async_engine)
 from sqlalchemy.orm import declarative_base # type: ignore
 from sqlalchemy.orm.decl_api import DeclarativeMeta
+from sqlalchemy.engine import Row
 from sqlalchemy.sql.expression import Executable
 from sqlalchemy.sql.schema import ForeignKey, Index
 
+from radio_db import metrics
 from radio_db.config import DatabaseConfig, PlaylistType
 
 log = logging.getLogger(__name__)
 
+# How long a SQLite writer waits for another to commit before giving up
+SQLITE_BUSY_TIMEOUT_MS = 30000
+
+DB_SESSIONS = metrics.Counter('radio_db_db_sessions_total', 'Database sessions opened')
+DB_EXEC_SECONDS = metrics.Histogram('radio_db_db_exec_seconds', 'Time taken to execute a statement, by type', ('statement',))
+DB_TRANSACTION_SECONDS = metrics.Histogram('radio_db_db_transaction_seconds', 'Time from the start of a transaction to its commit or rollback', ('outcome',))
+DB_COMMIT_SECONDS = metrics.Histogram('radio_db_db_commit_seconds', 'Time taken to commit')
+
 Base = declarative_base()
 
 class Station(Base):
@@ -28,6 +39,8 @@ class Station(Base):
     key     = Column(String, unique=True)
     name    = Column(String, nullable=False)
     url     = Column(String, nullable=False)
+    # detected stream format, see stream.PARSERS
+    parser  = Column(String)
 
 class Pending(Base):
     """A flat record of seen plays so that they can be processed in the background"""
@@ -40,6 +53,11 @@ class Pending(Base):
     seen_at     = Column(DateTime)
     picked_at   = Column(DateTime)
 
+    __table_args__ = (
+        # Claiming scans in seen_at order, filtering on picked_at
+        Index('pending_claim_index', 'seen_at', 'picked_at'),
+    )
+
 class Song(Base):
     __tablename__ = 'song'
 
@@ -62,6 +80,26 @@ class Play(Base):
     song        = Column(ForeignKey('song.id'))
     at          = Column(DateTime, nullable=False)
 
+    __table_args__ = (
+        # Covers the top songs query, so it needn't touch the table
+        Index('play_station_at_index', 'station', 'at', 'song'),
+    )
+
+class PlayDaily(Base):
+    """Play counts per station, song and day, kept up to date as plays are added"""
+    __tablename__ = 'play_daily'
+
+    station     = Column(ForeignKey('station.id'), primary_key=True)
+    song        = Column(ForeignKey('song.id'), primary_key=True)
+    day         = Column(Date, primary_key=True)
+    count       = Column(BigInteger, nullable=False)
+    last_played = Column(DateTime, nullable=False)
+
+    __table_args__ = (
+        # Covers the top songs query
+        Index('play_daily_station_day_index', 'station', 'day', 'song', 'count', 'last_played'),
+    )
+
 class Playlist(Base):
     __tablename__ = 'playlist'
 
@@ -69,6 +107,35 @@ class Playlist(Base):
     station     = Column(ForeignKey('station.id'))
     type_       = Column(Enum(PlaylistType))
     spotify_uri = Column(String, unique=True)
+    # track URIs last published, and the snapshot that left the playlist holding them
+    items       = Column(JSON)
+    snapshot_id = Column(String)
+
+class SpotifySearch(Base):
+    """Result of searching Spotify for a normalised artist and title, so it's only searched once"""
+    __tablename__ = 'spotify_search'
+
+    query       = Column(String, primary_key=True)
+    # null if nothing was found
+    spotify_uri = Column(String)
+    artist      = Column(String)
+    title       = Column(String)
+    searched_at = Column(DateTime, nullable=False)
+
+class StationLease(Base):
+    """Which monitor instance currently polls a station"""
+    __tablename__ = 'station_lease'
+
+    station     = Column(ForeignKey('station.id'), primary_key=True)
+    owner       = Column(String, nullable=False)
+    expires_at  = Column(DateTime, nullable=False)
+
+class MonitorNode(Base):
+    """Heartbeat of each running monitor instance, used to share out station leases"""
+    __tablename__ = 'monitor_node'
+
+    name        = Column(String, primary_key=True)
+    seen_at     = Column(DateTime, nullable=False)
 
 class StateKey(enum.Enum):
     SpotifyAuth = 'spotify_auth'
@@ -80,13 +147,24 @@ class State(Base):
     value       = Column(String)
 
 
+def _sqlite_connect(dbapi_connection: Any, _):
+    # Transactions aren't serialised in-process, so concurrent writers rely on
+    # SQLite: WAL lets readers carry on while one writes, and busy_timeout makes
+    # writers wait their turn rather than fail with "database is locked"
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.execute(f'PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}')
+    cursor.close()
+
+
 class RadioDatabase:
     
     def __init__(self, connection_string: str):
         self._connection_string = connection_string
-        self._tx_lock = asyncio.Lock()
-        self._session: ContextVar[AsyncSession] = ContextVar('session')
-        self._lock = Lock()
+        # The session in use, and the task using it. Tasks inherit their parent's 
+        # context, but mustn't share its session, so a session is only reused 
+        # by the task that created it.
+        self._session: ContextVar[Tuple[asyncio.Task[Any] | None, AsyncSession]] = ContextVar('session')
 
     @classmethod
     def from_config(cls, config: DatabaseConfig):
@@ -99,28 +177,59 @@ class RadioDatabase:
 
     def create_engine(self) -> AsyncEngine:
         engine: AsyncEngine = create_async_engine(self._connection_string, pool_size=10, max_overflow=20)
+        if engine.dialect.name == 'sqlite':
+            event.listen(engine.sync_engine, 'connect', _sqlite_connect)
         self._engine = engine
         return engine
 
     async def connect(self):
         self.create_engine()
 
+    @property
+    def dialect_name(self) -> str:
+        return self._engine.dialect.name
+
+    @asynccontextmanager
+    async def driver_connection(self) -> AsyncGenerator[Any, None]:
+        """A pooled connection of the underlying driver (e.g. asyncpg), for what 
+        SQLAlchemy doesn't do, like LISTEN. If anything goes wrong using it, it's 
+        closed rather than going back to the pool."""
+        async with self._engine.connect() as connection:
+            raw = await connection.get_raw_connection()
+            try:
+                yield raw.driver_connection
+            except BaseException:
+                await connection.invalidate()
+                raise
+
+    def insert(self, table: Type[Base] | Table) -> postgresql.Insert | sqlite.Insert: # type: ignore
+        """An INSERT for this database's dialect, for on_conflict_do_nothing/do_update"""
+        if self.dialect_name == 'sqlite':
+            return sqlite.insert(table)
+        # Also covers CockroachDB
+        return postgresql.insert(table)
+
+    def _current_session(self) -> AsyncSession | None:
+        owner, session = self._session.get((None, None)) # type: ignore
+        if session and owner is asyncio.current_task():
+            return session
+        return None
+
     @asynccontextmanager
     async def session(self) -> AsyncGenerator[AsyncSession, None]:
-        try:
-            # subsequent
-            session = self._session.get()
+        # subsequent
+        session = self._current_session()
+        if session:
             log.debug('using existing session')
             yield session
             return
-        except LookupError:
-            pass
         # first
         conn_context: AsyncConnection = self._engine.connect()
         async with conn_context as connection:
             async with AsyncSession(bind=connection, expire_on_commit=False) as session:
                 log.debug('created new session')
-                token = self._session.set(session)
+                DB_SESSIONS.inc()
+                token = self._session.set((asyncio.current_task(), session))
                 try:
                     yield session
                 finally:
@@ -128,21 +237,34 @@ class RadioDatabase:
 
     @asynccontextmanager
     async def transaction(self):
-        async with self._tx_lock, self.session() as session:
+        async with self.session() as session:
+            start = perf_counter()
             try:
                 yield
-                await session.commit()
+                with DB_COMMIT_SECONDS.time():
+                    await session.commit()
+                DB_TRANSACTION_SECONDS.observe('commit', value=perf_counter() - start)
             except:
                 await session.rollback()
+                DB_TRANSACTION_SECONDS.observe('rollback', value=perf_counter() - start)
                 raise
 
     async def add(self, item: Base):
         async with self.session() as session:
             session.add(item)            
 
-    async def exec(self, query: Executable):
+    async def exec(self, query: Executable, params: List[dict[str, Any]] | None = None):
+        """Execute query, once for each of params if given"""
+        async with self.session() as session:
+            with DB_EXEC_SECONDS.time(getattr(query, '__visit_name__', 'other')):
+                return await session.execute(query, params)
+
+    async def stream(self, query: Executable) -> AsyncGenerator[Row[Any], None]:
+        """Yield rows as they're fetched, using a server side cursor where supported"""
         async with self.session() as session:
-            return await session.execute(query)
+            result = await session.stream(query)
+            async for row in result:
+                yield row
 
     async def query(self, query: Executable):
         result = await self.exec(query)
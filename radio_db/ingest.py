@@ -0,0 +1,152 @@
+import asyncio
+import logging
+from time import monotonic
+from typing import Any, List
+
+from sqlalchemy import func, insert, select
+
+from . import metrics
+from .db import Pending, RadioDatabase
+
+log = logging.getLogger(__name__)
+
+PENDING_BUFFERED = metrics.Gauge('radio_db_pending_buffered', 'Seen songs waiting to be written')
+
+# NOTIFY channel that tells other processes there are new pending rows
+PENDING_CHANNEL = 'radio_db_pending'
+LISTEN_RETRY_SECONDS = 5
+# how often the listening connection is checked
+LISTEN_CHECK_SECONDS = 30
+
+
+class PendingWakeup:
+    """Wakes whatever's waiting for pending rows as soon as they're written: directly 
+    within this process, and by LISTEN/NOTIFY between processes on Postgres. 
+    Without it (SQLite, CockroachDB), other processes' rows have to be polled for."""
+
+    def __init__(self, db: RadioDatabase):
+        self.db = db
+        self.listening = False
+        self._event = asyncio.Event()
+
+    @property
+    def notifies(self) -> bool:
+        return self.db.dialect_name == 'postgresql'
+
+    async def notify(self):
+        """Tell other processes, as part of the transaction writing the rows"""
+        if self.notifies:
+            await self.db.exec(select(func.pg_notify(PENDING_CHANNEL, '')))
+
+    def set(self):
+        self._event.set()
+
+    def clear(self):
+        self._event.clear()
+
+    async def wait(self, timeout: float | None):
+        """Until rows are written, or timeout seconds"""
+        try:
+            await asyncio.wait_for(self._event.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    async def listen(self):
+        """Wake on other processes' notifications, reconnecting if the connection is lost.
+
+        Losing it - or it no longer answering, as a dropped connection isn't always 
+        noticed - wakes waiters, so they poll until it's back rather than missing rows."""
+        if not self.notifies:
+            return
+        while True:
+            try:
+                async with self.db.driver_connection() as connection:
+                    lost = asyncio.Event()
+                    connection.add_termination_listener(lambda *_: lost.set())
+                    await connection.add_listener(PENDING_CHANNEL, lambda *_: self._event.set())
+                    self.listening = True
+                    # Anything written while not listening was missed
+                    self._event.set()
+                    try:
+                        while True:
+                            try:
+                                await asyncio.wait_for(lost.wait(), LISTEN_CHECK_SECONDS)
+                            except asyncio.TimeoutError:
+                                await asyncio.wait_for(connection.execute('SELECT 1'), LISTEN_CHECK_SECONDS)
+                            else:
+                                raise ConnectionError('connection closed')
+                    finally:
+                        self.listening = False
+                        self._event.set()
+            except Exception as e:
+                log.warning(f'Not listening for pending rows ({e!r}), polling until reconnected')
+            await asyncio.sleep(LISTEN_RETRY_SECONDS)
+
+
+class PendingBuffer:
+    """Collects seen songs from every station and writes them as one multi-row INSERT.
+
+    Rows are written once max_rows have built up, or max_delay seconds after the 
+    oldest was added, whichever is first - so max_delay bounds what's lost if the 
+    process dies. A row added when nothing's been written for max_delay is written 
+    straight away, so a quiet system doesn't wait to batch. Anything left is 
+    written when run() is cancelled."""
+
+    def __init__(self, db: RadioDatabase, max_rows: int, max_delay: float, wakeup: PendingWakeup | None = None):
+        self.db = db
+        self.max_rows = max_rows
+        self.max_delay = max_delay
+        self.wakeup = wakeup
+        self._rows: List[dict[str, Any]] = []
+        self._flushed = 0.0
+        self._added = asyncio.Event()
+        self._full = asyncio.Event()
+
+    def add(self, **pending: Any):
+        self._rows.append(pending)
+        self._added.set()
+        PENDING_BUFFERED.set(value=len(self._rows))
+        if len(self._rows) >= self.max_rows:
+            self._full.set()
+
+    async def flush(self):
+        rows, self._rows = self._rows, []
+        self._added.clear()
+        self._full.clear()
+        if not rows:
+            return
+        try:
+            async with self.db.session():
+                async with self.db.transaction():
+                    await self.db.exec(insert(Pending).values(rows))
+                    if self.wakeup:
+                        await self.wakeup.notify()
+        except Exception:
+            # Keep them for the next attempt
+            self._rows[:0] = rows
+            self._added.set()
+            raise
+        finally:
+            self._flushed = monotonic()
+            PENDING_BUFFERED.set(value=len(self._rows))
+        if self.wakeup:
+            self.wakeup.set()
+        log.debug(f'Wrote {len(rows)} pending rows')
+
+    async def run(self):
+        try:
+            while True:
+                await self._added.wait()
+                delay = self._flushed + self.max_delay - monotonic()
+                if delay > 0:
+                    try:
+                        await asyncio.wait_for(self._full.wait(), delay)
+                    except asyncio.TimeoutError:
+                        pass
+                try:
+                    await self.flush()
+                except Exception:
+                    log.exception('Failed to write pending rows, will retry')
+                    await asyncio.sleep(self.max_delay)
+        finally:
+            await self.flush()
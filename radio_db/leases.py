@@ -0,0 +1,124 @@
+import logging
+from datetime import datetime, timedelta
+from math import ceil
+from typing import Iterable, Set
+
+from sqlalchemy import and_, func, insert, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.future import select
+
+from .db import MonitorNode, RadioDatabase, StationLease
+
+log = logging.getLogger(__name__)
+
+NEVER = datetime(1970, 1, 1)
+
+
+class StationLeases:
+    """Shares stations between monitor instances.
+
+    Each instance renews its leases on every heartbeat, and takes over leases 
+    that have expired (e.g. because their owner died) until it holds its fair 
+    share of the stations. Every change of ownership is a compare-and-set on 
+    expires_at, so a station is only ever leased to one instance at a time.
+    Instance clocks are assumed to be roughly in sync."""
+
+    def __init__(self, db: RadioDatabase, owner: str, ttl: timedelta):
+        self.db = db
+        self.owner = owner
+        self.ttl = ttl
+        # The stations this instance has configured, and so can monitor
+        self.station_ids: Set[int] = set()
+        self.target = 0
+        # When our leases run out if we fail to renew them
+        self.expires_at = NEVER
+
+    async def register(self, station_ids: Iterable[int]):
+        """Make sure there's a lease row for every station, so they can be claimed"""
+        self.station_ids = set(station_ids)
+        async with self.db.session():
+            existing = set(await self.db.query(select(StationLease.station)))
+            missing = self.station_ids - existing
+            if not missing:
+                return
+            try:
+                async with self.db.transaction():
+                    await self.db.exec(
+                        insert(StationLease)
+                        .values([ dict(station=id, owner='', expires_at=NEVER) for id in missing ])
+                    )
+            except IntegrityError:
+                # Another instance registered them at the same time
+                pass
+
+    async def heartbeat(self) -> Set[int]:
+        """Renew our leases and take over expired ones, up to our share.
+        Only stations passed to register() are renewed or taken, so leases
+        left by removed stations or peers with other config are ignored.
+        
+        Returns the stations we now hold."""
+        now = datetime.now()
+        expires_at = now + self.ttl
+        async with self.db.session():
+            async with self.db.transaction():
+                result = await self.db.exec(
+                    update(MonitorNode)
+                    .where(MonitorNode.name == self.owner)
+                    .values(seen_at=now)
+                )
+                if result.rowcount == 0:
+                    await self.db.add(MonitorNode(name=self.owner, seen_at=now))
+
+            nodes = await self.db.first(
+                select(func.count())
+                .select_from(MonitorNode)
+                .where(MonitorNode.seen_at > now - self.ttl)
+            )
+            self.target = ceil(len(self.station_ids) / max(nodes or 1, 1))
+
+            async with self.db.transaction():
+                renewed = await self.db.exec(
+                    update(StationLease)
+                    .where(and_(StationLease.owner == self.owner, StationLease.station.in_(self.station_ids)))
+                    .values(expires_at=expires_at)
+                    .returning(StationLease.station)
+                    .execution_options(synchronize_session=False)
+                )
+                held = set(renewed.scalars())
+
+            wanted = self.target - len(held)
+            if wanted > 0:
+                expired = (
+                    select(StationLease.station)
+                    .where(and_(StationLease.expires_at <= now, StationLease.station.in_(self.station_ids)))
+                    .order_by(StationLease.station)
+                    .limit(wanted)
+                    .with_for_update(skip_locked=True)
+                )
+                async with self.db.transaction():
+                    acquired = await self.db.exec(
+                        update(StationLease)
+                        .where(and_(StationLease.station.in_(expired), StationLease.expires_at <= now))
+                        .values(owner=self.owner, expires_at=expires_at)
+                        .returning(StationLease.station)
+                        .execution_options(synchronize_session=False)
+                    )
+                    held.update(acquired.scalars())
+
+        self.expires_at = expires_at
+        return held
+
+    async def release(self, station_ids: Iterable[int] | None = None):
+        """Give up leases so that other instances can take them straight away.
+        
+        Releases all of our leases if station_ids isn't given."""
+        query = update(StationLease).where(StationLease.owner == self.owner)
+        if station_ids is not None:
+            query = query.where(StationLease.station.in_(list(station_ids)))
+        async with self.db.session():
+            async with self.db.transaction():
+                await self.db.exec(
+                    query
+                    .values(owner='', expires_at=NEVER)
+                    .execution_options(synchronize_session=False)
+                )
@@ -9,7 +9,7 @@ from sqlalchemy import select
 
 from radio_db import db
 from radio_db.config import Config
-from radio_db.db import RadioDatabase, Station
+from radio_db.db import RadioDatabase, Song, Station
 from radio_db.stations import get_station, get_top_songs
 
 
@@ -35,12 +35,8 @@ async def fix_match(db: RadioDatabase):
 
 
 async def show_top_songs(db: RadioDatabase, station: Station):
-    n = 1
-    async for last_played, play_count, song in get_top_songs(db, station):
-        print(f'{song.artist} - {song.title}: {play_count} plays, last played {last_played}')
-        n += 1
-        if n > 10:
-            break
+    async for last_played, play_count, artist, title in get_top_songs(db, station, limit=10, columns=(Song.artist, Song.title)):
+        print(f'{artist} - {title}: {play_count} plays, last played {last_played}')
 
 
 async def manage_station(rdb: RadioDatabase, station_id: int):
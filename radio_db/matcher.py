@@ -0,0 +1,322 @@
+import logging
+from collections import OrderedDict, defaultdict
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from math import ceil
+from time import monotonic
+from typing import Any, FrozenSet, List, Set, Tuple
+
+from pydantic import BaseModel
+from sqlalchemy import and_, desc, func, or_
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.future import select
+
+from .config import StationConfig
+from .db import Pending, PlayDaily, RadioDatabase, Song, SpotifySearch, Station
+from .songs import normalise, song_key, trigrams, version_words
+from .spotify import SpotifyClient
+
+log = logging.getLogger(__name__)
+
+class SpotifyArtist(BaseModel):
+    name: str
+
+class SpotifyTrack(BaseModel):
+    name: str
+    artists: List[SpotifyArtist]
+    uri: str
+
+class SpotifyTracks(BaseModel):
+    items: List[SpotifyTrack]
+
+class SpotifyResult(BaseModel):
+    tracks: SpotifyTracks
+
+@dataclass
+class SongRef:
+    """Just enough of a Song to record a play of it"""
+    id: int
+    spotify_uri: str | None
+
+    @classmethod
+    def from_song(cls, song: Song) -> 'SongRef':
+        return cls(song.id, song.spotify_uri) # type: ignore
+
+
+class SongCache:
+    """Bounded LRU of song key to song, with entries expiring after ttl seconds.
+
+    The matcher only ever adds songs, never changes an existing song's match,
+    so there's nothing to invalidate in-process. Expiry is what picks up songs
+    re-matched by hand or by another process."""
+
+    def __init__(self, size: int, ttl: float):
+        self.size = size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._items: OrderedDict[int, tuple[float, SongRef]] = OrderedDict()
+
+    def get(self, key: int) -> SongRef | None:
+        item = self._items.get(key)
+        if item:
+            expires, song = item
+            if expires > monotonic():
+                self._items.move_to_end(key)
+                self.hits += 1
+                return song
+            del self._items[key]
+        self.misses += 1
+        return None
+
+    def put(self, key: int, song: SongRef):
+        if self.size <= 0:
+            return
+        self._items[key] = (monotonic() + self.ttl, song)
+        self._items.move_to_end(key)
+        while len(self._items) > self.size:
+            self._items.popitem(last=False)
+
+
+class SongIndex:
+    """In-memory trigram index of Songs by artist and title, to match spellings 
+    close to, but not exactly, those already seen.
+
+    Holds at most size songs, forgetting the least recently matched - the song
+    table can be far bigger (e.g. seeded from a catalog) than what's on air.
+
+    Songs only match if they name the same recording, so "X (Live)" or "X - Radio 
+    Edit" never match X however close the rest is."""
+
+    def __init__(self, size: int):
+        self.size = size
+        self._songs: OrderedDict[int, tuple[FrozenSet[str], FrozenSet[str], SongRef]] = OrderedDict()
+        self._postings: defaultdict[str, Set[int]] = defaultdict(set)
+
+    def __len__(self):
+        return len(self._songs)
+
+    def __contains__(self, song_id: int):
+        return song_id in self._songs
+
+    def add(self, song: SongRef, artist: str, title: str):
+        self.remove(song.id)
+        _, key_input = song_key(normalise(artist, title)) # type: ignore
+        grams = trigrams(key_input)
+        self._songs[song.id] = (grams, version_words(key_input), song)
+        for gram in grams:
+            self._postings[gram].add(song.id)
+        while len(self._songs) > self.size:
+            self.remove(next(iter(self._songs)))
+
+    def touch(self, song_id: int):
+        """Mark a song as just matched, so it's kept over others"""
+        if song_id in self._songs:
+            self._songs.move_to_end(song_id)
+
+    def remove(self, song_id: int):
+        item = self._songs.pop(song_id, None)
+        if item:
+            for gram in item[0]:
+                self._postings[gram].discard(song_id)
+
+    def match(self, key_input: str, threshold: float) -> Tuple[SongRef, float] | None:
+        """The most similar song to a song_key input and its similarity (shared over 
+        total trigrams, 0-1), if at least threshold"""
+        grams = trigrams(key_input)
+        if not grams:
+            return None
+        version = version_words(key_input)
+        # A song that similar has at least `needed` of these trigrams, so has 
+        # one of any len(grams) - needed + 1 of them - check the rarest
+        needed = ceil(threshold * len(grams))
+        probes = sorted(grams, key=lambda g: len(self._postings.get(g, ())))[:len(grams) - needed + 1]
+        candidates: Set[int] = set().union(*(self._postings.get(g, ()) for g in probes))
+
+        best: Tuple[SongRef, float] | None = None
+        for song_id in candidates:
+            song_grams, song_version, song = self._songs[song_id]
+            if song_version != version:
+                continue
+            shared = len(grams & song_grams)
+            score = shared / (len(grams) + len(song_grams) - shared)
+            if score >= threshold and (not best or score > best[1]):
+                best = (song, score)
+        if best:
+            self.touch(best[0].id)
+        return best
+
+
+class Matcher:
+    """Matches seen songs to Songs, locally if possible or else on Spotify"""
+
+    def __init__(self,
+        db: RadioDatabase,
+        spotify: SpotifyClient,
+        stations: List[StationConfig],
+        cache: SongCache,
+        miss_ttl: timedelta,
+        index: SongIndex | None = None,
+        fuzzy_threshold: float = 1.0
+    ):
+        self.db = db
+        self.spotify = spotify
+        self.stations = stations
+        self.cache = cache
+        self.miss_ttl = miss_ttl
+        self.index = index
+        self.fuzzy_threshold = fuzzy_threshold
+        self._station_table: dict[int, StationConfig] = {}
+
+    async def _search(self, normalised: str, query: str) -> SpotifySearch | None:
+        """Search Spotify for a song, remembering both hits and misses by query.
+
+        Returns None if Spotify couldn't be searched."""
+        rdb = self.db
+        now = datetime.now()
+        search: SpotifySearch | None = await rdb.first(
+            select(SpotifySearch)
+            .where(SpotifySearch.query == query)
+        )
+        if search and (search.spotify_uri or search.searched_at > now - self.miss_ttl):
+            if not search.spotify_uri:
+                log.debug(f'{normalised} is a known miss')
+            return search
+
+        response: dict[str, Any] | None = await self.spotify.search(q=normalised, type='track')
+        if not response:
+            return None
+
+        if not search:
+            search = SpotifySearch(query=query)
+        search.searched_at = now
+        search.spotify_uri = search.artist = search.title = None
+        items = SpotifyResult(**response).tracks.items
+        if len(items) > 0:
+            item = items[0]
+            search.artist = item.artists[0].name
+            search.title = item.name
+            search.spotify_uri = item.uri
+        else:
+            log.warning(f'{normalised} was not found on spotify')
+
+        try:
+            async with rdb.transaction():
+                await rdb.add(search)
+        except IntegrityError:
+            # Another matcher searched for it at the same time
+            pass
+        return search
+
+    async def load_index(self, since: datetime):
+        """Fill the index with the songs most recently played since since, 
+        up to its size. Others are added as they're matched."""
+        if self.index is None:
+            return
+        rows = list(await self.db.exec(
+            select(Song.id, Song.spotify_uri, Song.artist, Song.title)
+            .join(PlayDaily, PlayDaily.song == Song.id)
+            .where(PlayDaily.day >= since.date())
+            .group_by(Song.id)
+            .order_by(desc(func.max(PlayDaily.last_played)))
+            .limit(self.index.size)
+        ))
+        # Least recent first, so they're the first to go
+        for id, spotify_uri, artist, title in reversed(rows):
+            self.index.add(SongRef(id, spotify_uri), artist, title)
+        log.info(f'Indexed {len(self.index)} songs')
+
+    async def load_stations(self):
+        """(Re)build the table of station id to config, by matching station keys"""
+        by_key = { s.key: s for s in self.stations }
+        rows = await self.db.exec(select(Station.id, Station.key))
+        self._station_table = { id: by_key[key] for id, key in rows if key in by_key }
+
+    async def _station_config(self, station_id: int) -> StationConfig:
+        station_config = self._station_table.get(station_id)
+        if not station_config:
+            # Might be a station that's been added since the table was built
+            await self.load_stations()
+            station_config = self._station_table.get(station_id)
+            if not station_config:
+                raise Exception(f'Station {station_id} is not configured')
+        return station_config
+
+    async def process_song(self, pending: Pending) -> SongRef | None:
+        rdb = self.db
+        station_config = await self._station_config(pending.station) # type: ignore
+
+        # Try for an exact match in the database
+        if not pending.title.strip():
+            return None
+
+        normalised = normalise(pending.artist, pending.title, station_config.filters) # type: ignore
+        if normalised is None:
+            log.info(f'Ignoring {pending.artist} {pending.title}')
+            return None
+
+        key, key_input = song_key(normalised)
+        cached = self.cache.get(key)
+        if cached:
+            return cached
+
+        song = await rdb.first(
+            select(Song)
+            .where(Song.key == key)
+        )
+
+        # Or one spelled almost the same
+        if not song and self.index is not None:
+            match = self.index.match(key_input, self.fuzzy_threshold)
+            if match:
+                song_ref, score = match
+                log.debug(f'{normalised} matched song {song_ref.id} locally ({score:.2f})')
+                self.cache.put(key, song_ref)
+                return song_ref
+
+        # Failing that, try to find it on Spotify
+        if not song:
+            search = await self._search(normalised, key_input.strip())
+            if search and search.spotify_uri:
+                artist = search.artist
+                title = search.title
+                uri = search.spotify_uri
+
+                # And check - maybe it actually is in the database
+                song = await rdb.first(
+                    select(Song)
+                    .where(
+                        or_(
+                            Song.spotify_uri == uri,
+                            and_(Song.artist == artist, Song.title == title)
+                        )
+                    )
+                )
+                # Or not
+                if not song:
+                    song = Song(key=key, artist=artist, title=title, spotify_uri=uri)
+                    try:
+                        async with rdb.transaction():
+                            await rdb.add(song)
+                    except IntegrityError:
+                        # Another matcher got there first
+                        song = await rdb.first(
+                            select(Song)
+                            .where(
+                                or_(
+                                    Song.key == key,
+                                    Song.spotify_uri == uri,
+                                    and_(Song.artist == artist, Song.title == title)
+                                )
+                            )
+                        )
+        if not song:
+            return None
+        song_ref = SongRef.from_song(song)
+        if self.index is not None:
+            if song.id in self.index:
+                self.index.touch(song.id) # type: ignore
+            else:
+                self.index.add(song_ref, song.artist, song.title) # type: ignore
+        self.cache.put(key, song_ref)
+        return song_ref
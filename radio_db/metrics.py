@@ -0,0 +1,161 @@
+import asyncio
+import logging
+from bisect import bisect_left
+from contextlib import nullcontext
+from time import perf_counter
+from typing import Callable, ContextManager, Iterable, List, Tuple
+
+from aiohttp import web
+
+log = logging.getLogger(__name__)
+
+# Nothing is recorded until enable() is called, so instrumented code costs
+# little more than a function call when metrics are off
+_enabled = False
+_metrics: List['_Metric'] = []
+_NULL_TIMER = nullcontext()
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+Labels = Tuple[str, ...]
+Samples = Iterable[Tuple[Labels, float]]
+
+
+def enable():
+    global _enabled
+    _enabled = True
+
+
+def enabled() -> bool:
+    return _enabled
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class _Metric:
+    type = 'untyped'
+
+    def __init__(self, name: str, help: str, labels: Labels = ()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        _metrics.append(self)
+
+    def _label_text(self, values: Labels, extra: str = '') -> str:
+        pairs = [ f'{k}="{_escape(v)}"' for k, v in zip(self.labels, values) ]
+        if extra:
+            pairs.append(extra)
+        return '{' + ','.join(pairs) + '}' if pairs else ''
+
+    def samples(self) -> Iterable[str]:
+        raise NotImplementedError()
+
+    def render(self) -> str:
+        lines = [ f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.type}' ]
+        lines.extend(self.samples())
+        return '\n'.join(lines)
+
+
+class Counter(_Metric):
+    """A count that only goes up. Either inc() it, or pass collect to read
+    totals kept elsewhere when scraped."""
+    type = 'counter'
+
+    def __init__(self, name: str, help: str, labels: Labels = (), collect: Callable[[], Samples] | None = None):
+        super().__init__(name, help, labels)
+        self.collect = collect
+        self._values: dict[Labels, float] = {}
+
+    def inc(self, *labels: str, amount: float = 1):
+        if _enabled:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def samples(self):
+        values = self.collect() if self.collect else self._values.items()
+        for labels, value in values:
+            yield f'{self.name}{self._label_text(labels)} {value}'
+
+
+class Gauge(Counter):
+    """A value that goes up and down"""
+    type = 'gauge'
+
+    def set(self, *labels: str, value: float):
+        if _enabled:
+            self._values[labels] = value
+
+
+class Histogram(_Metric):
+    type = 'histogram'
+
+    def __init__(self, name: str, help: str, labels: Labels = (), buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = buckets
+        # per label values: count in each bucket (not cumulative) then +Inf, and the sum
+        self._values: dict[Labels, Tuple[List[int], List[float]]] = {}
+
+    def observe(self, *labels: str, value: float):
+        if not _enabled:
+            return
+        item = self._values.get(labels)
+        if not item:
+            item = self._values[labels] = ([0] * (len(self.buckets) + 1), [0.0])
+        counts, total = item
+        counts[bisect_left(self.buckets, value)] += 1
+        total[0] += value
+
+    def time(self, *labels: str) -> ContextManager[object]:
+        """Observe how long a with block takes"""
+        if not _enabled:
+            return _NULL_TIMER
+        return _Timer(self, labels)
+
+    def samples(self):
+        for labels, (counts, total) in self._values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                le = 'le="+Inf"' if bound == float('inf') else f'le="{bound!r}"'
+                yield f'{self.name}_bucket{self._label_text(labels, le)} {cumulative}'
+            yield f'{self.name}_sum{self._label_text(labels)} {total[0]}'
+            yield f'{self.name}_count{self._label_text(labels)} {cumulative}'
+
+
+class _Timer:
+
+    def __init__(self, histogram: Histogram, labels: Labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, *_):
+        self.histogram.observe(*self.labels, value=perf_counter() - self.start)
+
+
+def render() -> str:
+    """Every metric in Prometheus text format"""
+    return '\n'.join(m.render() for m in _metrics) + '\n'
+
+
+async def serve(port: int, host: str = '127.0.0.1'):
+    """Serve /metrics until cancelled"""
+
+    async def handle(_: web.Request):
+        return web.Response(body=render().encode(), headers={ 'Content-Type': CONTENT_TYPE })
+
+    app = web.Application()
+    app.router.add_get('/metrics', handle)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, host, port).start()
+        log.info(f'Serving metrics on http://{host}:{port}/metrics')
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
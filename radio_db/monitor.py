@@ -1,165 +1,227 @@
 import asyncio
 import logging
-import re
-from asyncio import to_thread
+import signal
+from collections import Counter
 from datetime import datetime, timedelta
-from hashlib import sha256
-from typing import Any, Coroutine, List, NoReturn
+from time import time
+from typing import Any, Callable, Coroutine, Iterable, List, NoReturn, Tuple
 
-from pydantic import BaseModel
-from spotipy import Spotify
-from spotipy.oauth2 import SpotifyClientCredentials
-from sqlalchemy import and_, delete, null, or_, update
+from sqlalchemy import delete, func, null, or_, tuple_, update
 from sqlalchemy.future import select
 
-from . import db, stream
-from .config import StationConfig
-from .db import Pending, Play, RadioDatabase, Song, Station
+from . import db, leases, metrics, stream
+from .config import Config, MonitorConfig, StationConfig
+from .connections import close_http_session, http_session
+from .db import Pending, RadioDatabase, Station
+from .ingest import PendingBuffer, PendingWakeup
+from .scheduler import PollScheduler
+from .matcher import Matcher, SongCache, SongIndex, SongRef
+from .playlists import PlaylistService
+from .spotify import ClientCredentials, SpotifyClient
+from .stations import record_plays
 
 log = logging.getLogger(__name__)
 
-class SpotifyArtist(BaseModel):
-    name: str
+# Polling cost of each monitored station, by station key
+station_stats: dict[str, stream.StreamStats] = {}
+# When each monitored station last had a new song, by station key
+last_seen: dict[str, float] = {}
 
-class SpotifyTrack(BaseModel):
-    name: str
-    artists: List[SpotifyArtist]
-    uri: str
+def _stream_stat(field: str) -> Callable[[], metrics.Samples]:
+    return lambda: [ ((key,), getattr(stats, field)) for key, stats in station_stats.items() ]
 
-class SpotifyTracks(BaseModel):
-    items: List[SpotifyTrack]
+STREAM_REQUESTS = metrics.Counter('radio_db_stream_requests_total', "Requests made for each station's stream", ('station',), _stream_stat('requests'))
+STREAM_NOT_MODIFIED = metrics.Counter('radio_db_stream_not_modified_total', "Requests for each station's stream that found it unchanged", ('station',), _stream_stat('not_modified'))
+STREAM_BYTES = metrics.Counter('radio_db_stream_bytes_total', "Bytes read from each station's stream", ('station',), _stream_stat('bytes'))
+STREAM_PARSES = metrics.Counter('radio_db_stream_parses_total', "Responses or metadata blocks parsed for each station", ('station',), _stream_stat('parses'))
+SONGS_SEEN = metrics.Counter('radio_db_songs_seen_total', 'New songs seen on each station', ('station',))
+LAST_SEEN_AGE = metrics.Gauge('radio_db_station_last_seen_age_seconds', 'Time since each station last had a new song', ('station',),
+    lambda: [ ((key,), time() - seen) for key, seen in last_seen.items() ])
+PENDING_CLAIMED = metrics.Counter('radio_db_pending_claimed_total', 'Pending rows claimed')
+PENDING_QUEUED = metrics.Gauge('radio_db_pending_queued', 'Rows waiting for the next stage of process_pending', ('queue',))
+PENDING_ROWS = metrics.Gauge('radio_db_pending_rows', 'Rows in the pending table, claimed or not')
+PENDING_OLDEST_AGE = metrics.Gauge('radio_db_pending_oldest_age_seconds', 'Time since the oldest row in the pending table was seen')
+MATCH_SECONDS = metrics.Histogram('radio_db_match_seconds', 'Time taken to match a seen song')
+MATCHED = metrics.Counter('radio_db_matched_total', 'Pending rows matched, by whether a song was found', ('result',))
+SEEN_TO_MATCHED_SECONDS = metrics.Histogram('radio_db_seen_to_matched_seconds', 'Time from a song being seen to its play being recorded',
+    buckets=(0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0, 1800.0))
 
-class SpotifyResult(BaseModel):
-    tracks: SpotifyTracks
+# A claimed row that hasn't been completed after this long is up for grabs again
+CLAIM_TIMEOUT = timedelta(minutes=5)
+# How often the pending table is measured, when metrics are enabled
+BACKLOG_SECONDS = 30
 
-async def process_pending(rdb: RadioDatabase, client_id, client_secret, stations: List[StationConfig]):
-    spotify_auth = SpotifyClientCredentials(client_id, client_secret)
-    spotify = Spotify(auth_manager=spotify_auth)
+async def _claim_pending(rdb: RadioDatabase, batch_size: int, station_keys: Iterable[str]) -> List[Pending]:
+    """Take ownership of up to batch_size pending rows of the given stations in a 
+    single statement. Other stations' rows are left for instances configured with them.
+    
+    Rows locked by another claimer are skipped (FOR UPDATE SKIP LOCKED). SQLite 
+    has no row locks but serialises writers, so the same statement is safe there."""
+    now = datetime.now()
+    claimable = (
+        select(Pending.id)
+        .where(
+            Pending.station.in_(select(Station.id).where(Station.key.in_(list(station_keys)))),
+            or_(
+                Pending.picked_at == null(),
+                Pending.picked_at <= (now - CLAIM_TIMEOUT)
+            )
+        )
+        .order_by(Pending.seen_at)
+        .limit(batch_size)
+        .with_for_update(skip_locked=True)
+    )
+    async with rdb.transaction():
+        result = await rdb.exec(
+            update(Pending)
+            .where(Pending.id.in_(claimable))
+            .values(picked_at=now)
+            .returning(Pending)
+            # The claimer's session may still hold a completed row with the same id
+            .execution_options(synchronize_session=False, populate_existing=True)
+        )
+        claimed: List[Pending] = list(result.scalars())
+    return sorted(claimed, key=lambda p: p.seen_at)
+
+async def _complete_pending(rdb: RadioDatabase, results: List[Tuple[Pending, SongRef | None]], playlist_service: PlaylistService | None = None):
+    """Write the plays for a set of matched rows and remove them from the queue.
+    
+    Only rows that are still owned (picked_at unchanged since the claim) are 
+    completed, so a row that timed out and was re-claimed elsewhere never 
+    produces a second play."""
+    async with rdb.transaction():
+        deleted = await rdb.exec(
+            delete(Pending)
+            .where(tuple_(Pending.id, Pending.picked_at).in_([ (p.id, p.picked_at) for p, _ in results ]))
+            .returning(Pending.id)
+            .execution_options(synchronize_session=False)
+        )
+        owned = set(deleted.scalars())
+        plays = [
+            dict(
+                station = pending.station,
+                song = song.id,
+                at = pending.seen_at
+            )
+            for pending, song in results
+            if song and pending.id in owned
+        ]
+        await record_plays(rdb, plays)
+    if playlist_service:
+        for station, count in Counter(play['station'] for play in plays).items():
+            playlist_service.played(station, count)
+    lost = len(results) - len(owned)
+    if lost:
+        log.warning(f'{lost} pending rows were re-claimed before they could be completed')
 
-    RE_NO_PUNC = re.compile(r'[^\w\s]')
-    RE_SPACES = re.compile(r'\s+')
+async def _measure_backlog(rdb: RadioDatabase):
+    """Set the gauges of how many rows are pending, and how long the oldest has waited"""
+    rows, oldest = (await rdb.exec(select(func.count(), func.min(Pending.seen_at)))).one()
+    PENDING_ROWS.set(value=rows)
+    PENDING_OLDEST_AGE.set(value=(datetime.now() - oldest).total_seconds() if oldest else 0)
 
+async def process_pending(
+    rdb: RadioDatabase,
+    spotify: SpotifyClient,
+    stations: List[StationConfig],
+    monitor_config: MonitorConfig = MonitorConfig(),
+    playlist_service: PlaylistService | None = None,
+    wakeup: PendingWakeup | None = None
+):
+    """Claim, match and complete pending rows as a pipeline.
+
+    One claimer feeds a bounded queue, monitor_config.matchers tasks match songs 
+    concurrently, and one writer completes the results in batches. The claimer 
+    waits on wakeup when there's nothing to claim, only polling when it isn't 
+    told about other processes' rows - and for claims abandoned by them."""
+    cache = SongCache(monitor_config.song_cache_size, monitor_config.song_cache_seconds)
+    matcher = Matcher(
+        rdb,
+        spotify,
+        stations,
+        cache,
+        timedelta(days=monitor_config.search_miss_days),
+        SongIndex(monitor_config.fuzzy_index_size) if monitor_config.fuzzy_match else None,
+        monitor_config.fuzzy_threshold
+    )
     async with rdb.session():
-        while True:
-            next_pending: Pending | None = await rdb.first(
-                select(Pending)
-                .where(
-                    or_(
-                        Pending.picked_at == null(),
-                        Pending.picked_at <= (datetime.now() - timedelta(minutes=5))
-                    )
-                )
-                .order_by(Pending.seen_at)
-            )
-            if not next_pending:
-                await asyncio.sleep(180)
-                continue
-            async with rdb.transaction():
-                # Take ownership by setting picked_at
-                result = await rdb.exec(
-                    update(Pending)
-                    .where(
-                        and_(
-                            Pending.id == next_pending.id,
-                            Pending.picked_at == next_pending.picked_at
-                        )
-                    )
-                    .values(picked_at=datetime.now())
-                    .execution_options(synchronize_session='fetch')
-                )
-                if not result:
-                    raise Exception("Expected result to be set")
+        await matcher.load_index(datetime.now() - timedelta(days=monitor_config.fuzzy_index_days))
 
-            if result.rowcount == 0:
-                # If the picked_at has changed then someone else picked it up in the mean time
-                continue
+    batch_size = monitor_config.batch_size
+    claimed_queue: asyncio.Queue[Pending] = asyncio.Queue(maxsize=monitor_config.queue_size)
+    matched_queue: asyncio.Queue[Tuple[Pending, SongRef | None]] = asyncio.Queue(maxsize=monitor_config.queue_size)
 
-            async def _process_song():
-                if not next_pending:
-                    raise Exception("next_pending should have been set already")
+    wakeup = wakeup or PendingWakeup(rdb)
+    # The matcher needs a station's config, so only those configured here are claimed
+    station_keys = [ s.key for s in stations ]
 
-                station = await rdb.first(
-                    select(Station)
-                    .where(Station.id == next_pending.station)
-                )
-                station_config = next(( s for s in stations if s.key == station.key ))
-                
-                # Try for an exact match in the database
-                artist = next_pending.artist
-                title = next_pending.title
-
-                if not title.strip():
-                    return
-
-                normalised = f'{next_pending.artist} {next_pending.title}'.replace(' - ', ' ').lower()
-
-                filters = station_config.filters
-                if filters:
-                    if filters.ignore and filters.ignore.search(normalised):
-                        log.info(f'Ignoring {normalised}')
-                        return
-                    if filters.blank:
-                        normalised = filters.blank.sub('', normalised)
-                
-                key_input = RE_NO_PUNC.sub('', normalised)
-                key = int.from_bytes(sha256(RE_SPACES.sub(' ', key_input).encode()).digest()[:8], 'little', signed=True)
-                song = await rdb.first(
-                    select(Song)
-                    .where(Song.key == key)
-                )
+    async def claim():
+        async with rdb.session():
+            while True:
+                # Cleared first, so rows written while claiming aren't missed
+                wakeup.clear()
+                # Don't claim more than can be queued, or claims could time out while waiting
+                free = claimed_queue.maxsize - claimed_queue.qsize()
+                claimed = await _claim_pending(rdb, max(1, min(batch_size, free)), station_keys)
+                if not claimed:
+                    await wakeup.wait(CLAIM_TIMEOUT.total_seconds() if wakeup.listening else monitor_config.pending_poll_seconds)
+                    continue
+                PENDING_CLAIMED.inc(amount=len(claimed))
+                for pending in claimed:
+                    await claimed_queue.put(pending)
+                PENDING_QUEUED.set('claimed', value=claimed_queue.qsize())
 
-                # Failing that, try to find it on Spotify
-                if not song:
-                    response: dict[str, Any] | None = await to_thread(lambda: spotify.search(q=normalised, type='track'))
-                    if not response:
-                        return
-
-                    result = SpotifyResult(**response)
-                    items = result.tracks.items
-                    if len(items) > 0:
-                        item = items[0]
-                        artist = item.artists[0].name
-                        title = item.name
-                        uri = item.uri
-        
-                        # And check - maybe it actually is in the database
-                        song = await rdb.first(
-                            select(Song)
-                            .where(
-                                or_(
-                                    Song.spotify_uri == uri,
-                                    and_(Song.artist == artist, Song.title == title)
-                                )
-                            )
-                        )
-                        # Or not
-                        if not song:
-                            song = Song(key=key, artist=artist, title=title, spotify_uri=uri)
-                            async with rdb.transaction():
-                                await rdb.add(song)
-                if not song:
-                    log.warning(f'{normalised} was not found on spotify')
-                return song
-
-            song = await _process_song()
+    async def match():
+        async with rdb.session():
+            while True:
+                pending = await claimed_queue.get()
+                with MATCH_SECONDS.time():
+                    song = await matcher.process_song(pending)
+                MATCHED.inc('found' if song else 'not_found')
+                await matched_queue.put((pending, song))
+                PENDING_QUEUED.set('claimed', value=claimed_queue.qsize())
+                PENDING_QUEUED.set('matched', value=matched_queue.qsize())
 
-            async with rdb.transaction():
-                if song:
-                    play = Play(
-                        station = next_pending.station,
-                        song = song.id,
-                        at = next_pending.seen_at
-                    )
-                    await rdb.add(play)
-                await rdb.exec(
-                    delete(Pending)
-                    .where(Pending.id == next_pending.id)
-                )
-                
+    async def write():
+        async with rdb.session():
+            last = time()
+            while True:
+                results = [ await matched_queue.get() ]
+                while len(results) < batch_size and not matched_queue.empty():
+                    results.append(matched_queue.get_nowait())
+                await _complete_pending(rdb, results, playlist_service)
+
+                now = time()
+                elapsed = max(now - last, 1e-6)
+                last = now
+                latencies = [ (datetime.now() - pending.seen_at).total_seconds() * 1000 for pending, _ in results ]
+                for latency in latencies:
+                    SEEN_TO_MATCHED_SECONDS.observe(value=latency / 1000)
+                PENDING_QUEUED.set('matched', value=matched_queue.qsize())
+                log.info(f'Processed {len(results)} pending rows in {elapsed:.1f}s ({len(results) / elapsed:.1f} rows/s), '
+                    f'seen to matched {sum(latencies) / len(latencies):.0f}ms mean {max(latencies):.0f}ms max, '
+                    f'song cache {cache.hits} hits {cache.misses} misses')
+
+    async def measure():
+        # Not part of the claimer, which stops while the matchers can't keep up
+        while True:
+            try:
+                async with rdb.session():
+                    await _measure_backlog(rdb)
+            except Exception:
+                log.exception('Failed to measure the pending backlog')
+            await asyncio.sleep(BACKLOG_SECONDS)
+
+    # Each stage runs in its own task, and so its own session
+    stages = [ claim(), write() ] + [ match() for _ in range(max(1, monitor_config.matchers)) ]
+    if metrics.enabled():
+        stages.append(measure())
+    await asyncio.gather(*stages)
 
-async def monitor_station(rdb: RadioDatabase, station_config: StationConfig):
+
+async def register_station(rdb: RadioDatabase, station_config: StationConfig) -> Station:
+    """Fetch and update, or insert station"""
     async with rdb.session():
-        # Fetch and update, or insert station
         station = await rdb.first(
             select(db.Station)
             .where(db.Station.key == station_config.key)
@@ -169,31 +231,160 @@ async def monitor_station(rdb: RadioDatabase, station_config: StationConfig):
             station.name = station_config.name
             station.url = station_config.url
         else:
-            station = db.Station(**station_config.dict(exclude={ 'filters', 'playlists' }))
+            station = db.Station(**station_config.dict(exclude={ 'filters', 'playlists', 'parser' }))
         async with rdb.transaction():
             await rdb.add(station)
+        return station
+
+async def monitor_station(rdb: RadioDatabase, buffer: PendingBuffer, scheduler: PollScheduler, station_config: StationConfig, station: Station | None = None):
+    """Add each new song on the station to buffer, for as long as it's monitored.
+
+    A session is only opened to write to the station, so waiting on the stream 
+    doesn't hold one of the pool's connections."""
+    if not station:
+        station = await register_station(rdb, station_config)
+
+    stats = station_stats.setdefault(station_config.key, stream.StreamStats())
+
+    async def save_parser(parser: str):
+        log.info(f'{station_config.name} is a {parser} stream')
+        async with rdb.session():
+            async with rdb.transaction():
+                await rdb.exec(
+                    update(db.Station)
+                    .where(db.Station.id == station.id)
+                    .values(parser=parser)
+                )
+
+    artist = ''
+    title = ''
+    async for item in stream.read_song_info(
+        station_config.url,
+        stats,
+        scheduler.schedule(),
+        parser=station_config.parser.value if station_config.parser else None,
+        detected=station.parser,
+        on_detect=save_parser
+    ):
+        if item.artist and item.title:
+            new_artist = item.artist
+            new_title = item.title
+            if new_artist != artist or new_title != title:
+                artist = new_artist
+                title = new_title
+                buffer.add(artist=artist, title=title, seen_at=datetime.now(), station=station.id)
+                SONGS_SEEN.inc(station_config.key)
+                last_seen[station_config.key] = time()
+                log.debug(f'{station_config.name}: {stats}')
+
+async def monitor_leased(rdb: RadioDatabase, buffer: PendingBuffer, scheduler: PollScheduler, stations: List[StationConfig], monitor_config: MonitorConfig):
+    """Monitor only the stations this instance holds a lease for, 
+    sharing the rest with other instances using the same database"""
+    configs: dict[int, StationConfig] = {}
+    rows: dict[int, Station] = {}
+    for station_config in stations:
+        station = await register_station(rdb, station_config)
+        configs[station.id] = station_config
+        rows[station.id] = station
 
-        artist = ''
-        title = ''
-        async for item in stream.read_song_info(station_config.url):
-            if item.artist and item.title:
-                new_artist = item.artist
-                new_title = item.title
-                if new_artist != artist or new_title != title:
-                    artist = new_artist
-                    title = new_title
-                    pending = db.Pending(artist=artist, title=title, seen_at=datetime.now(), station=station.id)
-                    async with rdb.transaction():
-                        await rdb.add(pending)
-
-async def run(config):
+    station_leases = leases.StationLeases(rdb, monitor_config.node_name, timedelta(seconds=monitor_config.lease_seconds))
+    await station_leases.register(configs.keys())
+    log.info(f'Sharing stations as {station_leases.owner}')
+
+    tasks: dict[int, asyncio.Task[None]] = {}
+
+    async def stop(station_ids: Iterable[int]):
+        to_stop = [ tasks.pop(id) for id in station_ids if id in tasks ]
+        for task in to_stop:
+            task.cancel()
+        await asyncio.gather(*to_stop, return_exceptions=True)
+
+    # Stations are stopped at least one heartbeat before their leases run
+    # out, so they're never still being polled when another instance takes over
+    interval = station_leases.ttl / 3
+    try:
+        while True:
+            started = datetime.now()
+            for id, task in list(tasks.items()):
+                if task.done():
+                    # Surface failures the same way the unsharded monitor does
+                    task.result()
+                    del tasks[id]
+
+            timeout = interval
+            if tasks:
+                # Don't let a hung database call run past the point we have to stop
+                timeout = min(interval, station_leases.expires_at - interval - started)
+            try:
+                held = await asyncio.wait_for(station_leases.heartbeat(), max(timeout.total_seconds(), 0))
+            except Exception:
+                log.exception('Failed to renew station leases')
+                if tasks and datetime.now() >= station_leases.expires_at - interval:
+                    log.warning('Stopping all stations before their leases expire')
+                    await stop(list(tasks))
+            else:
+                await stop([ id for id in tasks if id not in held ])
+                excess = sorted(held)[station_leases.target:]
+                if excess:
+                    await stop(excess)
+                    await station_leases.release(excess)
+                for id in held.difference(excess, tasks):
+                    log.info(f'Took lease on {configs[id].name}')
+                    tasks[id] = asyncio.create_task(monitor_station(rdb, buffer, scheduler, configs[id], rows[id]))
+
+            await asyncio.sleep(max((started + interval - datetime.now()).total_seconds(), 0))
+    finally:
+        await stop(list(tasks))
+        await station_leases.release()
+
+async def run(config: Config):
     db_conf = config.database
     rdb = db.RadioDatabase(db_conf.connection_string)
     await rdb.connect()
-    coros: list[Coroutine[Any, Any, None | NoReturn]] = [ monitor_station(rdb, s) for s in config.stations ]
-    coros.append(process_pending(rdb, config.spotify.client_id, config.spotify.client_secret, config.stations))
-    for t in asyncio.as_completed(coros):
-        await t
+
+    # Let docker stop etc. shut down cleanly, so buffered rows are written
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel) # type: ignore
+
+    wakeup = PendingWakeup(rdb)
+    buffer = PendingBuffer(rdb, config.monitor.ingest_max_rows, config.monitor.ingest_max_delay, wakeup)
+    scheduler = PollScheduler(
+        max_concurrent=config.monitor.poll_concurrency,
+        min_interval=config.monitor.poll_min_seconds,
+        max_interval=config.monitor.poll_max_seconds,
+        initial_interval=config.monitor.poll_initial_seconds,
+        jitter=config.monitor.poll_jitter,
+        start_spread=config.monitor.poll_start_spread
+    )
+    # Matching and playlists share one connection pool and rate limit for Spotify
+    spotify = SpotifyClient(ClientCredentials(config.spotify.client_id, config.spotify.client_secret), http_session())
+    coros: list[Coroutine[Any, Any, None | NoReturn]]
+    if config.monitor.sharded:
+        coros = [ monitor_leased(rdb, buffer, scheduler, config.stations, config.monitor) ]
+    else:
+        coros = [ monitor_station(rdb, buffer, scheduler, s) for s in config.stations ]
+    playlist_service = None
+    if config.monitor.playlists:
+        playlist_service = PlaylistService(
+            config,
+            rdb,
+            spotify,
+            config.monitor.playlist_debounce_seconds,
+            config.monitor.playlist_max_plays,
+            config.monitor.playlist_concurrency
+        )
+        coros.append(playlist_service.run())
+    coros.append(process_pending(rdb, spotify, config.stations, config.monitor, playlist_service, wakeup))
+    coros.append(buffer.run())
+    if wakeup.notifies:
+        coros.append(wakeup.listen())
+    if config.monitor.metrics_port:
+        metrics.enable()
+        coros.append(metrics.serve(config.monitor.metrics_port, config.monitor.metrics_host))
+    try:
+        for t in asyncio.as_completed(coros):
+            await t
+    finally:
+        await close_http_session()
 
 # if __name__ == '__main__':
 #     asyncio.run(run())
@@ -2,20 +2,27 @@ import asyncio
 import json
 import logging
 from base64 import b64decode
+from bisect import bisect_left
 from datetime import datetime, timedelta
+from time import monotonic
 from typing import Any, Generator, Iterable, List, Tuple
 
-from spotipy import Spotify, SpotifyOAuth, cache_handler
+from spotipy import cache_handler
 from sqlalchemy import and_, desc, func
 from sqlalchemy.future import select
 
 from radio_db.stations import get_top_songs
 
+from . import metrics
 from .config import Config, PlaylistConfig, PlaylistType, StationConfig
 from .db import Play, Playlist, RadioDatabase, Song, State, StateKey, Station
+from .spotify import SpotifyClient, UserAuth
 
 log = logging.getLogger(__name__)
 
+PLAYLIST_UPDATE_SECONDS = metrics.Histogram('radio_db_playlist_update_seconds', "Time taken to update a station's playlists", ('station',))
+PLAYLIST_SYNCS = metrics.Counter('radio_db_playlist_syncs_total', 'Playlists synced, by how', ('result',))
+
 PLAYLISTS = {
     PlaylistType.Top: {
         'name': "{station} most played",
@@ -23,6 +30,12 @@ PLAYLISTS = {
     }
 }
 
+# Spotify's limit on items added or removed per request
+ITEMS_PER_REQUEST = 100
+# A diff keeps the added dates of tracks that stay, so it's used even if it
+# takes up to this many more requests than replacing the playlist
+DIFF_EXTRA_REQUESTS = 5
+
 
 class DbCacheHandler(cache_handler.CacheHandler):
 
@@ -74,14 +87,14 @@ class DbCacheHandler(cache_handler.CacheHandler):
                 log.debug('set last run')
                 last_run = True
 
-async def get_playlist_uri(db: RadioDatabase, spotify: Spotify, station: Station, type: PlaylistType, name: str, desc: str):
+async def get_playlist(db: RadioDatabase, spotify: SpotifyClient, station: Station, type: PlaylistType, name: str, desc: str) -> Playlist:
     get_query = (
         select(Playlist)
         .where(and_(Playlist.station == station.id, Playlist.type_ == type))
     )
     playlist = await db.first(get_query)
     if playlist and playlist.spotify_uri:
-        return playlist.spotify_uri
+        return playlist
     if not playlist:
         async with db.transaction():
             playlist = Playlist(
@@ -92,71 +105,295 @@ async def get_playlist_uri(db: RadioDatabase, spotify: Spotify, station: Station
     async with db.transaction():
         playlist: Playlist = await db.first(get_query.with_for_update())
         if not playlist.spotify_uri:
-            user = spotify.current_user()
+            user = await spotify.current_user()
             assert user
-            sp_playlist = spotify.user_playlist_create(user['id'], name, public=False, description=desc)
+            sp_playlist = await spotify.user_playlist_create(user['id'], name, public=False, description=desc)
             assert sp_playlist
             playlist.spotify_uri = sp_playlist['uri']
             await db.add(playlist)
-    return playlist.spotify_uri
+    return playlist
+
+
+def _longest_increasing(values: List[int]) -> List[int]:
+    """One of the longest strictly increasing subsequences of values"""
+    tails: List[int] = []     # smallest last value of an increasing run of each length
+    tail_at: List[int] = []   # and its index
+    previous: List[int] = []  # index of the value before each in its run
+    for i, value in enumerate(values):
+        length = bisect_left(tails, value)
+        if length == len(tails):
+            tails.append(value)
+            tail_at.append(i)
+        else:
+            tails[length] = value
+            tail_at[length] = i
+        previous.append(tail_at[length - 1] if length else -1)
+    run: List[int] = []
+    i = tail_at[-1] if tail_at else -1
+    while i >= 0:
+        run.append(values[i])
+        i = previous[i]
+    return run[::-1]
+
+
+def plan_changes(old: List[str], new: List[str]) -> List[Tuple[Any, ...]]:
+    """The requests that turn playlist old into new - neither with duplicates - 
+    in the order they must be made: ('remove', uris), ('move', range_start, 
+    insert_before) and ('add', uris, position).
+
+    Songs already in the right order relative to each other (the longest such 
+    run) stay where they are, so there are as few moves as possible."""
+    ops: List[Tuple[Any, ...]] = []
+    wanted = { uri: i for i, uri in enumerate(new) }
+
+    removed = [ uri for uri in old if uri not in wanted ]
+    for i in range(0, len(removed), ITEMS_PER_REQUEST):
+        ops.append(('remove', removed[i:i + ITEMS_PER_REQUEST]))
+
+    current = [ uri for uri in old if uri in wanted ]
+    keep = set(_longest_increasing([ wanted[uri] for uri in current ]))
+    target = sorted(current, key=wanted.__getitem__)
+    for n, uri in enumerate(target):
+        if wanted[uri] in keep:
+            continue
+        # Put it straight after whatever comes before it, which is already in place
+        start = current.index(uri)
+        before = current.index(target[n - 1]) + 1 if n else 0
+        if before in (start, start + 1):
+            continue
+        ops.append(('move', start, before))
+        current.insert(before - 1 if start < before else before, current.pop(start))
+
+    kept = set(current)
+    i = 0
+    while i < len(new):
+        if new[i] in kept:
+            i += 1
+            continue
+        end = i
+        while end < len(new) and new[end] not in kept and end - i < ITEMS_PER_REQUEST:
+            end += 1
+        ops.append(('add', new[i:end], i))
+        i = end
+    return ops
+
+
+async def _replace_items(spotify: SpotifyClient, playlist_uri: str, items: List[str]) -> str:
+    result = await spotify.playlist_replace_items(playlist_uri, items[:ITEMS_PER_REQUEST])
+    for i in range(ITEMS_PER_REQUEST, len(items), ITEMS_PER_REQUEST):
+        result = await spotify.playlist_add_items(playlist_uri, items[i:i + ITEMS_PER_REQUEST])
+    return result['snapshot_id']
 
 
-async def update_top(db: RadioDatabase, spotify: Spotify, station: Station, playlist_config: PlaylistConfig):
+async def sync_playlist(db: RadioDatabase, spotify: SpotifyClient, playlist: Playlist, items: List[str]):
+    """Make the Spotify playlist hold items, disturbing it as little as possible.
+
+    Nothing is sent if they're what was last published. Otherwise they're applied 
+    as changes to what was published, keeping the added dates of tracks that stay.
+    It's replaced instead if that takes over DIFF_EXTRA_REQUESTS more requests, 
+    or if it's been changed elsewhere since - its snapshot differs, which is only 
+    checked if the changes would be used."""
+    playlist_uri: str = playlist.spotify_uri # type: ignore
+    published: List[str] | None = playlist.items # type: ignore
+    if published == items:
+        log.info(f'{playlist_uri} is unchanged')
+        PLAYLIST_SYNCS.inc('unchanged')
+        return
+
+    ops = None
+    if published is not None and playlist.snapshot_id:
+        ops = plan_changes(published, items)
+        if len(ops) > max(1, -(-len(items) // ITEMS_PER_REQUEST)) + DIFF_EXTRA_REQUESTS:
+            ops = None
+        else:
+            current = await spotify.playlist(playlist_uri, fields='snapshot_id')
+            if current['snapshot_id'] != playlist.snapshot_id:
+                log.info(f'{playlist_uri} has been changed elsewhere, replacing it')
+                ops = None
+
+    if ops is None:
+        PLAYLIST_SYNCS.inc('replace')
+        snapshot_id = await _replace_items(spotify, playlist_uri, items)
+    else:
+        PLAYLIST_SYNCS.inc('diff')
+        log.info(f'Updating {playlist_uri} with {len(ops)} requests')
+        snapshot_id = playlist.snapshot_id
+        for op in ops:
+            if op[0] == 'remove':
+                result = await spotify.playlist_remove_items(playlist_uri, op[1], snapshot_id)
+            elif op[0] == 'move':
+                result = await spotify.playlist_reorder_items(playlist_uri, op[1], op[2], snapshot_id=snapshot_id)
+            else:
+                result = await spotify.playlist_add_items(playlist_uri, op[1], op[2])
+            snapshot_id = result['snapshot_id']
+
+    async with db.transaction():
+        playlist.items = items # type: ignore
+        playlist.snapshot_id = snapshot_id # type: ignore
+        await db.add(playlist)
+
+
+async def update_top(db: RadioDatabase, spotify: SpotifyClient, station: Station, playlist_config: PlaylistConfig):
     log.info(f'Updating top playlist for {station.name}')
     TOP = PLAYLISTS[PlaylistType.Top]
 
     playlist_name = TOP['name'].format(station=station.name)
     playlist_desc = TOP['description'].format(station=station.name, days=playlist_config.days)
 
-    playlist_uri = await get_playlist_uri(db, spotify, station, PlaylistType.Top, playlist_name, playlist_desc)
+    playlist = await get_playlist(db, spotify, station, PlaylistType.Top, playlist_name, playlist_desc)
 
-    results = get_top_songs(db, station)
+    results = get_top_songs(db, station, playlist_config.days, playlist_config.limit, (Song.spotify_uri, Song.artist, Song.title))
     items = []
-    n = 0
-    async for last_played, play_count, song in results:
-        log.debug(f'Add to playlist: {last_played} {play_count} {song.artist} - {song.title}')
-        items.append(song.spotify_uri)
-        if n + 1 >= 100:
-            break
-        n += 1
-    spotify.playlist_replace_items(playlist_uri, items)
+    async for last_played, play_count, spotify_uri, artist, title in results:
+        if spotify_uri:
+            log.debug(f'Add to playlist: {last_played} {play_count} {artist} - {title}')
+            items.append(spotify_uri)
+    await sync_playlist(db, spotify, playlist, items)
+
+
+async def update_station(db: RadioDatabase, spotify: SpotifyClient, station_config: StationConfig):
+    with PLAYLIST_UPDATE_SECONDS.time(station_config.key):
+        async with db.session():
+            station = await db.first(
+                select(Station)
+                .where(Station.key == station_config.key)
+            )
+            if not station:
+                raise Exception(f'{station_config.key} is not a known station')
+
+            for playlist in station_config.playlists:
+                log.info(f'Updating playlists for {station_config.name}')
+                if playlist.type == PlaylistType.Top:
+                    await update_top(db, spotify, station, playlist)
+
 
+async def update(config: Config, station_keys: Iterable[str] | None = None, concurrency: int = 4) -> List[Tuple[StationConfig, float, BaseException | None]]:
+    """Update the playlists of the given stations, or all of them, up to concurrency at once.
 
-async def update(config: Config, station_key: str):
+    Every station shares one database engine, one Spotify client, and one task
+    saving the refreshed token. Returns how long each station took, and what
+    it failed with if it did."""
     db_conf = config.database
     rdb = RadioDatabase(db_conf.connection_string)
     await rdb.connect()
+
+    keys = set(station_keys) if station_keys else None
+    station_configs = [ s for s in config.stations if keys is None or s.key in keys ]
+    if keys:
+        unknown = keys.difference(s.key for s in station_configs)
+        if unknown:
+            raise Exception(f'{", ".join(unknown)} not configured')
+
+    sp_conf = config.spotify
+    cache_handler = DbCacheHandler(rdb)
     async with rdb.session():
-        station = await rdb.first(
-            select(Station)
-            .where(Station.key == station_key)
-        )
-        if not station:
-            raise Exception(f'{station_key} is not a known station')
+        await cache_handler.populate_from_db(sp_conf.auth_seed)
+    sp = SpotifyClient(UserAuth(sp_conf.client_id, sp_conf.client_secret, cache_handler))
+    limit = asyncio.Semaphore(concurrency)
 
-        station_config: StationConfig = next(( s for s in config.stations if s.key == station_key ))
+    async def timed(station_config: StationConfig) -> Tuple[StationConfig, float, BaseException | None]:
+        async with limit:
+            start = monotonic()
+            try:
+                await update_station(rdb, sp, station_config)
+                error = None
+            except Exception as e:
+                log.exception(f'Failed to update playlists for {station_config.name}')
+                error = e
+            return station_config, monotonic() - start, error
 
-        sp_conf = config.spotify
-        cache_handler = DbCacheHandler(rdb)
+    cache_save_task = asyncio.create_task(cache_handler.save_as_needed())
+    try:
+        return await asyncio.gather(*[ timed(s) for s in station_configs ])
+    finally:
+        await sp.close()
+        cache_save_task.cancel()
+        await cache_save_task
 
-        async def _update():
-            log.debug('_update running')
-            await cache_handler.populate_from_db(sp_conf.auth_seed)
-            sp = Spotify(auth_manager=SpotifyOAuth(
-                scope='playlist-modify-private', 
-                redirect_uri='http://localhost:9090', 
-                client_id=sp_conf.client_id, 
-                client_secret=sp_conf.client_secret,
-                cache_handler=cache_handler)
-            )
 
-            for playlist in station_config.playlists:
-                log.info(f'Updating playlists for {station_config.name}')
-                if playlist.type == PlaylistType.Top:
-                    await update_top(rdb, sp, station, playlist)
+class PlaylistService:
+    """Rebuilds a station's playlists after it has new plays - debounce seconds
+    after the first since its last rebuild, or as soon as max_plays have built
+    up. Stations with no new plays are left alone.
+
+    Runs inside the monitor, sharing its database engine, and spotify's connection
+    pool and rate limit. process_pending reports plays with played() once they're 
+    committed."""
+
+    def __init__(self, config: Config, db: RadioDatabase, spotify: SpotifyClient, debounce: float, max_plays: int, concurrency: int):
+        self.config = config
+        self.db = db
+        self.spotify = spotify
+        self.debounce = debounce
+        self.max_plays = max_plays
+        self.concurrency = concurrency
+        # station id -> (plays since its last rebuild, when the first of them was recorded)
+        self._new_plays: dict[int, Tuple[int, float]] = {}
+        self._rebuilding: set[int] = set()
+        self._stations: dict[int, StationConfig] = {}
+        self._changed = asyncio.Event()
+
+    def played(self, station_id: int, count: int = 1):
+        plays, first = self._new_plays.get(station_id, (0, monotonic()))
+        self._new_plays[station_id] = (plays + count, first)
+        self._changed.set()
 
+    async def _station_config(self, station_id: int) -> StationConfig | None:
+        if station_id not in self._stations:
+            by_key = { s.key: s for s in self.config.stations }
+            async with self.db.session():
+                rows = await self.db.exec(select(Station.id, Station.key))
+            self._stations = { id: by_key[key] for id, key in rows if key in by_key }
+        return self._stations.get(station_id)
+
+    async def _rebuild(self, spotify: SpotifyClient, limit: asyncio.Semaphore, station_id: int, plays: int):
+        try:
+            async with limit:
+                station_config = await self._station_config(station_id)
+                if not station_config or not station_config.playlists:
+                    return
+                start = monotonic()
+                await update_station(self.db, spotify, station_config)
+                log.info(f'Rebuilt playlists for {station_config.name} after {plays} new plays in {monotonic() - start:.1f}s')
+        except Exception:
+            log.exception(f'Failed to rebuild playlists for station {station_id}')
+        finally:
+            self._rebuilding.discard(station_id)
+            self._changed.set()
+
+    async def run(self):
+        sp_conf = self.config.spotify
+        cache_handler = DbCacheHandler(self.db)
+        async with self.db.session():
+            await cache_handler.populate_from_db(sp_conf.auth_seed)
+        spotify = self.spotify.with_auth(UserAuth(sp_conf.client_id, sp_conf.client_secret, cache_handler))
         cache_save_task = asyncio.create_task(cache_handler.save_as_needed())
-        update_task = asyncio.create_task(_update())
-        await asyncio.wait([ update_task, cache_save_task ], return_when=asyncio.FIRST_COMPLETED)
-        cache_save_task.cancel()
-        await cache_save_task
+        limit = asyncio.Semaphore(self.concurrency)
+        tasks: set[asyncio.Task[None]] = set()
+        try:
+            while True:
+                self._changed.clear()
+                now = monotonic()
+                for station_id, (plays, first) in list(self._new_plays.items()):
+                    if station_id in self._rebuilding:
+                        # Wait for it to finish, then go again
+                        continue
+                    if plays >= self.max_plays or now - first >= self.debounce:
+                        del self._new_plays[station_id]
+                        self._rebuilding.add(station_id)
+                        task = asyncio.create_task(self._rebuild(spotify, limit, station_id, plays))
+                        tasks.add(task)
+                        task.add_done_callback(tasks.discard)
+
+                waiting = [ first for id, (_, first) in self._new_plays.items() if id not in self._rebuilding ]
+                timeout = max(0, min(waiting) + self.debounce - now) if waiting else None
+                try:
+                    await asyncio.wait_for(self._changed.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            cache_save_task.cancel()
+            await cache_save_task
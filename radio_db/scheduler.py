@@ -0,0 +1,89 @@
+import asyncio
+import random
+from contextlib import asynccontextmanager
+from time import monotonic
+from typing import AsyncIterator
+
+# weight given to the latest gap between song changes in a station's average
+GAP_WEIGHT = 0.3
+# how much longer each poll of an overdue station waits than the last
+BACKOFF = 1.5
+
+
+class PollScheduler:
+    """Decides when every station is next polled.
+
+    Streams that give their own timing (HLS target durations) are polled on
+    that. Others are polled slowly just after a song changes, more often as
+    the next change becomes due - judged from the station's average gap
+    between changes - and back off again once it's overdue. Delays are
+    jittered so stations drift apart, and at most max_concurrent requests
+    are in flight at once."""
+
+    def __init__(self,
+        max_concurrent: int = 16,
+        min_interval: float = 10,
+        max_interval: float = 300,
+        initial_interval: float = 60,
+        jitter: float = 0.1,
+        start_spread: float = 10
+    ):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.initial_interval = initial_interval
+        self.jitter = jitter
+        self.start_spread = start_spread
+        self._slots = asyncio.Semaphore(max_concurrent)
+
+    def schedule(self) -> 'PollSchedule':
+        return PollSchedule(self)
+
+
+class PollSchedule:
+    """Poll timing for one station"""
+
+    def __init__(self, scheduler: PollScheduler):
+        self.scheduler = scheduler
+        self.mean_gap: float | None = None
+        self._interval = scheduler.min_interval
+        self._last_change: float | None = None
+        self._started = False
+
+    @asynccontextmanager
+    async def slot(self) -> AsyncIterator[None]:
+        """Hold one of the scheduler's request slots while polling.
+        A station's first poll is put off by a random amount so they don't all start at once."""
+        if not self._started:
+            self._started = True
+            await asyncio.sleep(random.uniform(0, self.scheduler.start_spread))
+        async with self.scheduler._slots:
+            yield
+
+    def next_delay(self, changed: bool, hint: float | None = None) -> float:
+        s = self.scheduler
+        now = monotonic()
+        if changed:
+            if self._last_change is not None:
+                gap = now - self._last_change
+                self.mean_gap = gap if self.mean_gap is None else self.mean_gap + GAP_WEIGHT * (gap - self.mean_gap)
+            self._last_change = now
+
+        if hint is not None:
+            return max(0, hint) * random.uniform(1 - s.jitter, 1)
+
+        if self.mean_gap is None or self._last_change is None:
+            delay = s.initial_interval
+        elif (due := self._last_change + self.mean_gap - now) > 0:
+            # Close in on when the next song should start
+            delay = due / 2
+            self._interval = s.min_interval
+        else:
+            delay = self._interval
+            self._interval = min(self._interval * BACKOFF, s.max_interval)
+        delay = min(max(delay, s.min_interval), s.max_interval)
+        return delay * random.uniform(1 - s.jitter, 1 + s.jitter)
+
+    async def wait(self, changed: bool, hint: float | None = None):
+        """Sleep until the station should be polled again.
+        hint is when the stream itself says there'll be something new."""
+        await asyncio.sleep(self.next_delay(changed, hint))
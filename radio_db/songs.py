@@ -0,0 +1,50 @@
+import re
+from hashlib import sha256
+from typing import FrozenSet, Tuple
+
+from .config import FilterConfig
+
+RE_NO_PUNC = re.compile(r'[^\w\s]')
+RE_SPACES = re.compile(r'\s+')
+# left out of trigrams, so that "feat." vs "ft." doesn't count against a match
+TRIGRAM_IGNORE = { 'feat', 'ft', 'featuring' }
+# words naming a different recording of a song, which a near spelling mustn't match
+VERSION_WORDS = {
+    'acapella', 'acoustic', 'cover', 'demo', 'dub', 'edit', 'extended', 'instrumental',
+    'karaoke', 'live', 'mix', 'remix', 'unplugged', 'version'
+}
+
+
+def normalise(artist: str, title: str, filters: FilterConfig | None = None) -> str | None:
+    """The lower case search string for a seen song, or None if filters say to ignore it"""
+    normalised = f'{artist} {title}'.replace(' - ', ' ').lower()
+    if filters:
+        if filters.ignore and filters.ignore.search(normalised):
+            return None
+        if filters.blank:
+            normalised = filters.blank.sub('', normalised)
+    return normalised
+
+
+def song_key(normalised: str) -> Tuple[int, str]:
+    """The Song.key for a normalised string, and the string without punctuation that it was computed from.
+    
+    The key is the first 64 bits of sha256 of that string."""
+    key_input = RE_SPACES.sub(' ', RE_NO_PUNC.sub('', normalised))
+    key = int.from_bytes(sha256(key_input.encode()).digest()[:8], 'little', signed=True)
+    return key, key_input
+
+
+def trigrams(key_input: str) -> FrozenSet[str]:
+    """Trigrams of each word of a song_key input, padded as pg_trgm does"""
+    grams = set()
+    for word in key_input.split():
+        if word not in TRIGRAM_IGNORE:
+            padded = f'  {word} '
+            grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return frozenset(grams)
+
+
+def version_words(key_input: str) -> FrozenSet[str]:
+    """Words of a song_key input that say which recording it is, e.g. live or remix"""
+    return frozenset(word for word in key_input.split() if word in VERSION_WORDS)
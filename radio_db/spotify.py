@@ -0,0 +1,258 @@
+"""A small asyncio Spotify Web API client covering what radio_db uses"""
+
+import asyncio
+import logging
+from base64 import b64encode
+from time import monotonic, perf_counter, time
+from typing import Any, List
+
+import aiohttp
+from spotipy import CacheHandler
+
+from . import metrics
+
+log = logging.getLogger(__name__)
+
+SPOTIFY_REQUEST_SECONDS = metrics.Histogram('radio_db_spotify_request_seconds', 'Time taken by Spotify API requests, by endpoint and status', ('endpoint', 'status'))
+
+API_URL = 'https://api.spotify.com/v1'
+TOKEN_URL = 'https://accounts.spotify.com/api/token'
+
+
+class SpotifyError(Exception):
+
+    def __init__(self, status: int, message: str):
+        super().__init__(f'{status}: {message}')
+        self.status = status
+
+
+class TokenBucket:
+    """Spaces out requests to at most rate per second, allowing bursts of up to burst.
+    
+    pause() holds everyone back, e.g. when Spotify asks us to Retry-After."""
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds: float):
+        self._paused_until = max(self._paused_until, monotonic() + seconds)
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class _Auth:
+    """Supplies access tokens, fetching new ones from the accounts service as they expire"""
+
+    def __init__(self, client_id: str, client_secret: str):
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self._lock = asyncio.Lock()
+
+    def _get_token(self) -> Any:
+        raise NotImplementedError()
+
+    def _save_token(self, token: Any):
+        raise NotImplementedError()
+
+    def _grant(self) -> dict[str, str]:
+        raise NotImplementedError()
+
+    async def access_token(self, http: aiohttp.ClientSession, token_url: str, force_refresh = False) -> str:
+        async with self._lock:
+            token = self._get_token()
+            if force_refresh or not token or token.get('expires_at', 0) - 60 < time():
+                basic = b64encode(f'{self.client_id}:{self.client_secret}'.encode()).decode()
+                async with http.post(token_url, data=self._grant(), headers={ 'Authorization': f'Basic {basic}' }) as response:
+                    if response.status != 200:
+                        raise SpotifyError(response.status, await response.text())
+                    new_token = await response.json()
+                new_token['expires_at'] = int(time()) + new_token['expires_in']
+                # Refresh responses may leave out the refresh token, in which case it's still valid
+                token = { **(token or {}), **new_token }
+                self._save_token(token)
+            return token['access_token']
+
+
+class ClientCredentials(_Auth):
+    """App-only auth, for searching"""
+
+    def __init__(self, client_id: str, client_secret: str):
+        super().__init__(client_id, client_secret)
+        self._token: Any = None
+
+    def _get_token(self):
+        return self._token
+
+    def _save_token(self, token: Any):
+        self._token = token
+
+    def _grant(self):
+        return { 'grant_type': 'client_credentials' }
+
+
+class UserAuth(_Auth):
+    """Auth as a user, from a previously authorised token kept by cache_handler"""
+
+    def __init__(self, client_id: str, client_secret: str, cache_handler: CacheHandler):
+        super().__init__(client_id, client_secret)
+        self.cache_handler = cache_handler
+
+    def _get_token(self):
+        return self.cache_handler.get_cached_token()
+
+    def _save_token(self, token: Any):
+        self.cache_handler.save_token_to_cache(token)
+
+    def _grant(self):
+        return { 'grant_type': 'refresh_token', 'refresh_token': self._get_token()['refresh_token'] }
+
+
+def _playlist_id(playlist: str):
+    # Accept spotify:playlist:<id> URIs as well as bare ids
+    return playlist.split(':')[-1]
+
+
+class SpotifyClient:
+    """Async Spotify client. 
+    
+    All requests share one connection pool and one rate limit. Pass api_url and 
+    token_url to point it at something other than Spotify, e.g. a fake for testing."""
+
+    def __init__(self, 
+        auth: _Auth, 
+        http: aiohttp.ClientSession | None = None, 
+        api_url: str = API_URL, 
+        token_url: str = TOKEN_URL, 
+        rate: float = 10.0, 
+        burst: int = 10,
+        max_retries: int = 5,
+        retry_backoff: float = 1.0,
+    ):
+        self.auth = auth
+        self.api_url = api_url
+        self.token_url = token_url
+        self.bucket = TokenBucket(rate, burst)
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self._http = http
+        self._owns_http = http is None
+
+    @property
+    def http(self) -> aiohttp.ClientSession:
+        if not self._http:
+            self._http = aiohttp.ClientSession()
+        return self._http
+
+    def with_auth(self, auth: _Auth) -> 'SpotifyClient':
+        """A client using auth that shares this one's connection pool and rate limit"""
+        client = SpotifyClient(auth, self.http, self.api_url, self.token_url, max_retries=self.max_retries, retry_backoff=self.retry_backoff)
+        client.bucket = self.bucket
+        return client
+
+    async def close(self):
+        if self._owns_http and self._http:
+            await self._http.close()
+        self._http = None
+
+    def _path(self, url: str) -> str:
+        """The path of a URL Spotify returned (e.g. the next page), relative to api_url"""
+        if not url.startswith(self.api_url):
+            raise ValueError(f'{url} is not under {self.api_url}')
+        return url[len(self.api_url):]
+
+    async def request(self, method: str, path: str, **kwargs: Any) -> Any:
+        force_refresh = False
+        for attempt in range(self.max_retries + 1):
+            try:
+                token = await self.auth.access_token(self.http, self.token_url, force_refresh)
+                force_refresh = False
+                await self.bucket.acquire()
+                start = perf_counter()
+                async with self.http.request(method, self.api_url + path, headers={ 'Authorization': f'Bearer {token}' }, **kwargs) as response:
+                    SPOTIFY_REQUEST_SECONDS.observe(path.split('/')[1], str(response.status), value=perf_counter() - start)
+                    if response.status == 429:
+                        retry_after = float(response.headers.get('Retry-After', 1))
+                        log.warning(f'Spotify rate limit hit, retrying after {retry_after}s')
+                        self.bucket.pause(retry_after)
+                        continue
+                    if response.status == 401 and attempt == 0:
+                        force_refresh = True
+                        continue
+                    if response.status >= 500 and attempt < self.max_retries:
+                        await asyncio.sleep(self.retry_backoff * 2 ** attempt)
+                        continue
+                    if response.status >= 400:
+                        raise SpotifyError(response.status, await response.text())
+                    if response.content_type == 'application/json':
+                        return await response.json()
+                    return None
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                # Connection resets, DNS failures and the like are retried as server errors are
+                if attempt == self.max_retries:
+                    raise
+                log.warning(f'{method} {path} failed ({e!r}), retrying')
+                await asyncio.sleep(self.retry_backoff * 2 ** attempt)
+        raise SpotifyError(429, f'Gave up on {method} {path} after {self.max_retries} retries')
+
+    async def search(self, q: str, type: str = 'track', limit: int = 10) -> Any:
+        return await self.request('GET', '/search', params={ 'q': q, 'type': type, 'limit': limit })
+
+    async def current_user(self) -> Any:
+        return await self.request('GET', '/me')
+
+    async def user_playlist_create(self, user: str, name: str, public: bool = True, description: str = '') -> Any:
+        return await self.request('POST', f'/users/{user}/playlists', json={ 
+            'name': name, 
+            'public': public, 
+            'description': description 
+        })
+
+    async def playlist(self, playlist: str, fields: str | None = None) -> Any:
+        """The playlist, with every one of its tracks if they're included - 
+        Spotify pages them, so the rest are fetched and added to the first page"""
+        result = await self.request('GET', f'/playlists/{_playlist_id(playlist)}', params={ 'fields': fields } if fields else None)
+        tracks = result.get('tracks') if result else None
+        while tracks and tracks.get('next'):
+            page = await self.request('GET', self._path(tracks['next']))
+            tracks['items'].extend(page['items'])
+            tracks['next'] = page.get('next')
+        return result
+
+    async def playlist_replace_items(self, playlist: str, items: List[str]) -> Any:
+        return await self.request('PUT', f'/playlists/{_playlist_id(playlist)}/tracks', json={ 'uris': items })
+
+    async def playlist_add_items(self, playlist: str, items: List[str], position: int | None = None) -> Any:
+        body: dict[str, Any] = { 'uris': items }
+        if position is not None:
+            body['position'] = position
+        return await self.request('POST', f'/playlists/{_playlist_id(playlist)}/tracks', json=body)
+
+    async def playlist_remove_items(self, playlist: str, items: List[str], snapshot_id: str | None = None) -> Any:
+        """Removes every occurrence of each item"""
+        body: dict[str, Any] = { 'tracks': [ { 'uri': uri } for uri in items ] }
+        if snapshot_id:
+            body['snapshot_id'] = snapshot_id
+        return await self.request('DELETE', f'/playlists/{_playlist_id(playlist)}/tracks', json=body)
+
+    async def playlist_reorder_items(self, playlist: str, range_start: int, insert_before: int, range_length: int = 1, snapshot_id: str | None = None) -> Any:
+        body: dict[str, Any] = { 'range_start': range_start, 'insert_before': insert_before, 'range_length': range_length }
+        if snapshot_id:
+            body['snapshot_id'] = snapshot_id
+        return await self.request('PUT', f'/playlists/{_playlist_id(playlist)}/tracks', json=body)
@@ -1,8 +1,9 @@
-from datetime import datetime, timedelta
-from typing import Iterable, Tuple
+from collections import defaultdict
+from datetime import date, datetime, time, timedelta
+from typing import Any, AsyncGenerator, List, Sequence, Tuple
 
-from sqlalchemy import and_, desc, func, select
-from radio_db.db import Play, RadioDatabase, Song, Station
+from sqlalchemy import ColumnElement, Row, and_, case, delete, desc, func, insert, select, union_all
+from radio_db.db import Play, PlayDaily, RadioDatabase, Song, Station
 
 
 async def get_station(rdb: RadioDatabase, id: int):
@@ -12,17 +13,86 @@ async def get_station(rdb: RadioDatabase, id: int):
     return station
 
 
-async def get_top_songs(db: RadioDatabase, station: Station):
-    results: Iterable[Tuple[datetime, int, Song]] = await db.exec(
-        select(func.max(Play.at).label('last_played'), func.count(Play.id).label('play_count'), Song)
-            .join(Song)
-            .where(and_(Play.at > (datetime.now() - timedelta(days=7)), Play.station == station.id)) # type: ignore
-            .group_by(Song.id)
-            .order_by(desc('play_count'), desc('last_played'))
-    )
-    for result in results:
-        yield result
+async def record_plays(db: RadioDatabase, plays: List[dict[str, Any]]):
+    """Insert plays and add them to the daily rollup. Call within a transaction."""
+    if not plays:
+        return
+    await db.exec(insert(Play).values(plays))
+
+    rollup: dict[Tuple[int, int, date], dict[str, Any]] = defaultdict(lambda: dict(count=0, last_played=datetime.min))
+    for play in plays:
+        day = rollup[(play['station'], play['song'], play['at'].date())]
+        day['count'] += 1
+        day['last_played'] = max(day['last_played'], play['at'])
+    upsert = db.insert(PlayDaily).values([
+        dict(station=station, song=song, day=day, **counts)
+        for (station, song, day), counts in rollup.items()
+    ])
+    await db.exec(upsert.on_conflict_do_update(
+        index_elements=[ PlayDaily.station, PlayDaily.song, PlayDaily.day ],
+        set_=dict(
+            count=PlayDaily.count + upsert.excluded.count,
+            last_played=case(
+                (upsert.excluded.last_played > PlayDaily.last_played, upsert.excluded.last_played),
+                else_=PlayDaily.last_played
+            )
+        )
+    ))
+
 
+async def rebuild_play_daily(db: RadioDatabase):
+    """Recreate the daily rollup from all plays"""
+    day = func.date(Play.at)
+    async with db.session():
+        async with db.transaction():
+            await db.exec(delete(PlayDaily))
+            await db.exec(
+                insert(PlayDaily)
+                .from_select(
+                    [ 'station', 'song', 'day', 'count', 'last_played' ],
+                    select(Play.station, Play.song, day, func.count(), func.max(Play.at))
+                    .where(and_(Play.station != None, Play.song != None))
+                    .group_by(Play.station, Play.song, day)
+                )
+            )
 
 
+async def get_top_songs(
+    db: RadioDatabase, 
+    station: Station, 
+    days: int = 7, 
+    limit: int = 100, 
+    columns: Sequence[ColumnElement[Any]] = (Song.artist, Song.title, Song.spotify_uri)
+) -> AsyncGenerator[Row[Any], None]:
+    """Stream the station's most played songs over the last days, most played first.
+    
+    Each row has last_played, play_count and then the requested Song columns.
 
+    Whole days come from the daily rollup. The window rarely starts at midnight,
+    so the part of its first day that's inside it is counted from the plays."""
+    since = datetime.now() - timedelta(days=days)
+    first_day = since.date()
+    whole_days = (
+        select(PlayDaily.song, PlayDaily.count, PlayDaily.last_played)
+        .where(and_(PlayDaily.station == station.id, PlayDaily.day > first_day)) # type: ignore
+    )
+    part_day = (
+        select(Play.song, func.count(), func.max(Play.at))
+        .where(and_(
+            Play.station == station.id,
+            Play.at > since,
+            Play.at < datetime.combine(first_day + timedelta(days=1), time.min),
+            Play.song != None
+        ))
+        .group_by(Play.song)
+    )
+    plays = union_all(whole_days, part_day).subquery()
+    results = db.stream(
+        select(func.max(plays.c.last_played).label('last_played'), func.sum(plays.c.count).label('play_count'), *columns)
+            .join(Song, Song.id == plays.c.song)
+            .group_by(Song.id)
+            .order_by(desc('play_count'), desc('last_played'))
+            .limit(limit)
+    )
+    async for result in results:
+        yield result
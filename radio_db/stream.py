@@ -1,34 +1,112 @@
 import asyncio
 import json
 import logging
-from itertools import takewhile
+import re
+from contextlib import AsyncExitStack, asynccontextmanager
 from time import time
-from typing import AsyncGenerator, Callable, List
+from collections import deque
+from typing import Any, AsyncGenerator, AsyncIterator, Awaitable, Callable, Deque, List, Mapping, Set, Tuple, Type
+from urllib.parse import urljoin, urlsplit
 from dataclasses import dataclass
 
 import aiohttp
 from pydantic import BaseModel
 import pydantic
 
+from . import metrics
+from .connections import http_session, stream_session
+from .scheduler import PollSchedule, PollScheduler
+
 log = logging.getLogger(__name__)
 
+STREAM_POLL_SECONDS = metrics.Histogram('radio_db_stream_poll_seconds', 'Time taken to poll a stream, by parser', ('parser',))
+STREAM_FORMAT_ERRORS = metrics.Counter('radio_db_stream_format_errors_total', 'Streams a parser failed to read', ('parser',))
+
 @dataclass
 class SongInfo:
     title: str
     file: str = ''
     artist: str = ''
 
+@dataclass
+class StreamStats:
+    """What polling a station has cost"""
+    requests: int = 0
+    not_modified: int = 0
+    bytes: int = 0
+    parses: int = 0
+
 class Stream:
 
-    def __init__(self, stream_url: str):
+    def __init__(self, stream_url: str, stats: StreamStats | None = None, schedule: PollSchedule | None = None):
         self.stream_url = stream_url
+        self.stats = stats or StreamStats()
+        self.schedule = schedule or PollScheduler().schedule()
+        self._etag: str | None = None
+        self._last_modified: str | None = None
 
     async def read_song_info(self) -> AsyncGenerator[SongInfo, None]:
         yield SongInfo(title='')
         raise NotImplementedError()
 
+    async def _poll(self, http: aiohttp.ClientSession, magic: bytes = b'') -> bytes | None:
+        """GET the stream URL, or None if it hasn't changed since the last poll.
+
+        If the body doesn't start with magic, gives up without reading the rest
+        (which might be never-ending audio)."""
+        headers: dict[str, str] = {}
+        if self._etag:
+            headers['If-None-Match'] = self._etag
+        if self._last_modified:
+            headers['If-Modified-Since'] = self._last_modified
+
+        self.stats.requests += 1
+        with STREAM_POLL_SECONDS.time(type(self).__name__):
+            async with http.get(self.stream_url, headers=headers) as response:
+                if response.status == 304:
+                    self.stats.not_modified += 1
+                    return None
+                body = b''
+                if magic:
+                    try:
+                        body = await response.content.readexactly(len(magic))
+                    except asyncio.IncompleteReadError:
+                        body = b''
+                    if body != magic:
+                        raise FormatError(f'Not a {type(self).__name__} stream')
+                body += await response.content.read()
+                self.stats.bytes += len(body)
+                self._etag = response.headers.get('ETag')
+                self._last_modified = response.headers.get('Last-Modified')
+                return body
+
+class _Recent:
+    """The last size items seen"""
+
+    def __init__(self, size: int):
+        self._order: Deque[str] = deque(maxlen=size)
+        self._items: Set[str] = set()
+
+    def add(self, item: str) -> bool:
+        """Remember item, returning whether it's new"""
+        if item in self._items:
+            return False
+        if len(self._order) == self._order.maxlen:
+            self._items.discard(self._order[0])
+        self._order.append(item)
+        self._items.add(item)
+        return True
+
 M3U8_MAGIC = '#EXTM3U'.encode()
 
+# Tokens in an #EXTINF attribute value, in order: a backslash escaped character, 
+# a quoted string (which may be unterminated), the comma ending the value, 
+# or unquoted text (ignored)
+RE_INF_TOKEN = re.compile(r'\\(.)|"([^"\\]*(?:\\.[^"\\]*)*)"?|(,)|[^"\\,]+|\\', re.DOTALL)
+# Splits around escaped characters, keeping the characters (without backslashes)
+RE_ESCAPED = re.compile(r'\\(.)', re.DOTALL)
+RE_BANDWIDTH = re.compile(r'[:,]BANDWIDTH=(\d+)')
+
 class FormatError(Exception):
     pass
 
@@ -41,154 +119,284 @@ class _M3u8Info:
 class M3u8(Stream):
 
 
-    async def _read_stream_inf(_self, url_line: str):
+    def _pick_variant(self, lines: List[str]) -> str | None:
         """Example:
             #EXT-X-STREAM-INF:BANDWIDTH=33000,CODECS="mp4a.40.5"
             https://url-to-another-stream.m3u8
+
+        Every variant carries the same song info, so returns the URL of the 
+        cheapest, or None if this isn't a master playlist.
         """
-        m3u8 = M3u8(url_line)
-        async for result in m3u8.read_song_info():
-            yield result
+        variants: List[Tuple[int, str]] = []
+        for line1, line2 in zip(lines, lines[1:]):
+            if line1.startswith('#EXT-X-STREAM-INF:'):
+                bandwidth = RE_BANDWIDTH.search(line1)
+                variants.append((int(bandwidth.group(1)) if bandwidth else 0, urljoin(self.stream_url, line2)))
+        if not variants:
+            return None
+        return min(variants)[1]
 
     def _read_inf(_self, tag_line: str, url_line: str) -> _M3u8Info:
-        tag_map: dict[str, str] = {}
-
-        chars = iter(tag_line)
-        pop = lambda: next(chars, None)
-        until: Callable[[str], str] = lambda c: ''.join(takewhile(lambda d: c != d, chars))
+        """Example:
+            #EXTINF:10.0,title="Song \\"Name\\"",artist="Artist"
+            https://url-to-segment.aac
 
-        duration = float(until(','))
+        Values are the concatenation of their quoted parts and backslash 
+        escaped characters. Anything else unquoted is ignored.
+        """
+        tag_map: dict[str, str] = {}
 
-        eol = False
-        while not eol:
-            # key
-            key = until('=')
-            
-            # value
+        duration, _, attrs = tag_line.partition(',')
+        pos = 0
+        while True:
+            eq = attrs.find('=', pos)
+            if eq == -1:
+                tag_map[attrs[pos:]] = ''
+                break
+            key = attrs[pos:eq]
             value = ''
-            escape = False
-            quote = False
-            while not eol:
-                c = pop()
-                if not c:
-                    eol = True
-                    break
-                if escape:
-                    value += c
-                    escape = False
-                elif c == '\\':
-                    escape = True
-                elif quote:
-                    if c == '"':
-                        quote = False
-                    else:
-                        value += c
-                elif c == '"':
-                    quote = True
-                elif c == ',':
+            for token in RE_INF_TOKEN.finditer(attrs, eq + 1):
+                escaped, quoted, comma = token.groups()
+                if comma:
+                    pos = token.end()
                     break
-
+                if escaped is not None:
+                    value += escaped
+                elif quoted is not None:
+                    value += ''.join(RE_ESCAPED.split(quoted)) if '\\' in quoted else quoted
+            else:
+                # end of line
+                tag_map[key] = value
+                break
             tag_map[key] = value
 
         return _M3u8Info(
             file=url_line,
-            duration=duration,
+            duration=float(duration),
             tags=tag_map
         )
 
     async def read_song_info(self) -> AsyncGenerator[SongInfo, None]:
-        recent: List[None | str] = [None] * 20
-        def not_recent(item: SongInfo | _M3u8Info):
-            file = item.file
-            if file in recent:
-                return False
-            recent.append(file)
-            recent.pop(0)
-            return True
-
-        async with aiohttp.ClientSession() as http:
-            while True:
-                target_duration = 5.0
-                response = await http.get(self.stream_url)
-                async def readline():
-                    return (await response.content.readline()).decode().strip()
-
-                header = await response.content.read(len(M3U8_MAGIC))
-                if header != M3U8_MAGIC:
-                    raise FormatError('Not an m3u8 stream')
-
-                await readline() # To consume rest of header line
-                line2 = await readline()
-                while True:
-                    line1 = line2
-                    line2 = await readline()
-                    if not line1:
-                        break
-                    try:
-                        tag, value = tuple(line1.split(':', maxsplit=1))
-                    except ValueError:
-                        tag, value = line1, ''
-                    if tag == '#EXT-X-STREAM-INF':
-                        async for item in self._read_stream_inf(line2):
-                            if not_recent(item):
-                                yield item
-                    elif tag == '#EXT-X-TARGETDURATION':
-                        target_duration = float(min(target_duration, max(int(value), 1)))
-                    elif tag == '#EXTINF': 
-                        inf = self._read_inf(value, line2)
-                        target_duration = float(max(0, min(target_duration, inf.duration or target_duration)) - 1)
-                        if not_recent(inf):
-                            start = time()
-
-                            title = inf.tags.get('title', '')
-                            artist = inf.tags.get('artist', '')
-
-                            yield SongInfo(
-                                title=title,
-                                artist=artist,
-                                file=inf.file
-                            )
+        # Segments are identified by media sequence number, or by file if the 
+        # playlist doesn't have one
+        last_sequence = -1
+        recent = _Recent(20)
+        target_duration = 5.0
+
+        http = http_session()
+        while True:
+            async with self.schedule.slot():
+                body = await self._poll(http, M3U8_MAGIC)
+            if body is None:
+                await self.schedule.wait(False, target_duration)
+                continue
+            self.stats.parses += 1
+
+            target_duration = 5.0
+            lines = [ line for line in (l.strip() for l in body.decode().splitlines()[1:]) if line ]
+
+            variant_url = self._pick_variant(lines)
+            if variant_url:
+                # Follow the one variant until it fails, then pick again
+                log.debug(f'Following {variant_url} for {self.stream_url}')
+                try:
+                    async for item in M3u8(variant_url, self.stats, self.schedule).read_song_info():
+                        if recent.add(item.file):
+                            yield item
+                except (FormatError, aiohttp.ClientError) as e:
+                    log.warning(f'Variant {variant_url} of {self.stream_url} failed ({e}), picking again')
+                self._etag = self._last_modified = None
+                await self.schedule.wait(False, target_duration)
+                continue
+
+            sequence: int | None = None
+            segment = 0
+            changed = False
+            for line1, line2 in zip(lines, lines[1:] + ['']):
+                try:
+                    tag, value = tuple(line1.split(':', maxsplit=1))
+                except ValueError:
+                    tag, value = line1, ''
+                if tag == '#EXT-X-TARGETDURATION':
+                    target_duration = float(min(target_duration, max(int(value), 1)))
+                elif tag == '#EXT-X-MEDIA-SEQUENCE':
+                    sequence = int(value)
+                    last_segment = sequence + sum(1 for l in lines if l.startswith('#EXTINF:')) - 1
+                    if last_segment < last_sequence:
+                        # The stream has restarted
+                        last_sequence = sequence - 1
+                elif tag == '#EXTINF': 
+                    inf = self._read_inf(value, line2)
+                    target_duration = float(max(0, min(target_duration, inf.duration or target_duration)) - 1)
+                    if sequence is None:
+                        is_new = recent.add(inf.file)
+                    else:
+                        is_new = sequence + segment > last_sequence
+                        last_sequence = max(last_sequence, sequence + segment)
+                    segment += 1
+                    if is_new:
+                        changed = True
+                        start = time()
+
+                        title = inf.tags.get('title', '')
+                        artist = inf.tags.get('artist', '')
+
+                        yield SongInfo(
+                            title=title,
+                            artist=artist,
+                            file=inf.file
+                        )
 
-                            end = time()
-                            target_duration = max(0, target_duration - (end - start))
+                        end = time()
+                        target_duration = max(0, target_duration - (end - start))
 
-                await asyncio.sleep(target_duration)
+            await self.schedule.wait(changed, target_duration)
 
-class _FfTags(BaseModel):
-    StreamTitle: str
+ICY_RECONNECT_SECONDS = 5
+ICY_READ_SECONDS = 60
+ICY_MAX_REDIRECTS = 5
+ICY_CHUNK = 64 * 1024
+RE_STREAM_TITLE = re.compile(rb"StreamTitle='(.*?)';", re.DOTALL)
 
-class _FfFormat(BaseModel):
-    tags: _FfTags
+def _is_icy_status(e: aiohttp.ClientResponseError) -> bool:
+    """Whether aiohttp failed because the server answered "ICY 200 OK" (SHOUTcast v1)"""
+    return e.message.startswith('Bad status line') and 'ICY' in e.message
 
-class _FfOut(BaseModel):
-    format: _FfFormat
+class _TimedReader:
+    """A StreamReader that gives up if a read takes longer than timeout seconds"""
+
+    def __init__(self, reader: asyncio.StreamReader, timeout: float):
+        self.reader = reader
+        self.timeout = timeout
+
+    async def read(self, n: int) -> bytes:
+        return await asyncio.wait_for(self.reader.read(n), self.timeout)
+
+    async def readexactly(self, n: int) -> bytes:
+        return await asyncio.wait_for(self.reader.readexactly(n), self.timeout)
+
+    async def readline(self) -> bytes:
+        return await asyncio.wait_for(self.reader.readline(), self.timeout)
 
 class Icy(Stream):
+    """Reads in-band Shoutcast/Icecast metadata from one long-lived connection,
+    throwing the audio away as it arrives"""
+
+    def __init__(self, stream_url: str, stats: StreamStats | None = None, schedule: PollSchedule | None = None):
+        super().__init__(stream_url, stats, schedule)
+        # Set once the server turns out to answer with an ICY status line
+        self._icy_status = False
+
+    @asynccontextmanager
+    async def _connect(self) -> AsyncIterator[Tuple[Mapping[str, str], Any]]:
+        """The stream's headers and body, using aiohttp unless the server's 
+        status line is one it won't parse"""
+        if not self._icy_status:
+            async with AsyncExitStack() as stack:
+                try:
+                    response = await stack.enter_async_context(stream_session().get(
+                        self.stream_url,
+                        headers={ 'Icy-MetaData': '1' },
+                        timeout=aiohttp.ClientTimeout(sock_read=ICY_READ_SECONDS)
+                    ))
+                except aiohttp.ClientResponseError as e:
+                    if not _is_icy_status(e):
+                        raise
+                    log.info(f'{self.stream_url} has an ICY status line, reading it directly')
+                    self._icy_status = True
+                else:
+                    yield response.headers, response.content
+                    return
+        async with self._connect_direct() as (headers, content):
+            yield headers, content
+
+    @asynccontextmanager
+    async def _connect_direct(self) -> AsyncIterator[Tuple[Mapping[str, str], _TimedReader]]:
+        """GET the stream over a plain connection, accepting an "ICY 200 OK" 
+        status line as well as HTTP ones. Header names are lower-cased."""
+        url = self.stream_url
+        for _ in range(ICY_MAX_REDIRECTS + 1):
+            parts = urlsplit(url)
+            secure = parts.scheme == 'https'
+            reader, writer = await asyncio.wait_for(
+                asyncio.open_connection(parts.hostname, parts.port or (443 if secure else 80), ssl=secure or None),
+                ICY_READ_SECONDS
+            )
+            try:
+                path = (parts.path or '/') + (f'?{parts.query}' if parts.query else '')
+                host = parts.netloc.rpartition('@')[2]
+                writer.write(f'GET {path} HTTP/1.0\r\nHost: {host}\r\nIcy-MetaData: 1\r\n\r\n'.encode())
+                content = _TimedReader(reader, ICY_READ_SECONDS)
+
+                status_line = (await content.readline()).decode('latin-1').split()
+                if len(status_line) < 2 or not status_line[1].isdigit():
+                    raise FormatError('Not an icy stream')
+                headers: dict[str, str] = {}
+                while line := (await content.readline()).strip():
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+
+                location = headers.get('location')
+                if 300 <= int(status_line[1]) < 400 and location:
+                    url = urljoin(url, location)
+                    continue
+                yield headers, content
+                return
+            finally:
+                writer.close()
+        raise FormatError(f'Too many redirects from {self.stream_url}')
+
+    async def _read_titles(self, content: Any, metaint: int) -> AsyncGenerator[str, None]:
+        while True:
+            # Skip the audio
+            remaining = metaint
+            while remaining:
+                chunk = await content.read(min(remaining, ICY_CHUNK))
+                if not chunk:
+                    return
+                remaining -= len(chunk)
+            length = (await content.readexactly(1))[0] * 16
+            self.stats.bytes += metaint + 1 + length
+            if not length:
+                # No change since the last block
+                continue
+            metadata = await content.readexactly(length)
+            self.stats.parses += 1
+            title = RE_STREAM_TITLE.search(metadata)
+            if title:
+                yield title.group(1).decode(errors='replace')
 
     async def read_song_info(self) -> AsyncGenerator[SongInfo, None]:
-        prev_result = {}
+        prev_result = None
+        connected = False
         while True:
-            proc = await asyncio.create_subprocess_exec('ffprobe', '-v', 'error', '-show_format', '-of', 'json', self.stream_url, stdout=asyncio.subprocess.PIPE)
-            stdout, _ = await proc.communicate()
+            self.stats.requests += 1
             try:
-                ff_out = _FfOut(**json.loads(stdout.decode()))
-            except pydantic.error_wrappers.ValidationError:
-                raise FormatError('Not an icy stream')
-            song = ff_out.format.tags.StreamTitle.split(' - ', maxsplit=1)
-            if len(song) == 2:
-                artist, title = tuple(song)
-                result = SongInfo(
-                    title=title,
-                    artist=artist
-                )
-            else:
-                result = SongInfo(
-                    title=song[0]
-                )
-            if prev_result != result:
-                prev_result = result
-                yield result
-            await asyncio.sleep(120)
+                async with self._connect() as (headers, content):
+                    metaint = headers.get('icy-metaint')
+                    if not metaint:
+                        raise FormatError('Not an icy stream')
+                    connected = True
+                    async for stream_title in self._read_titles(content, int(metaint)):
+                        song = stream_title.split(' - ', maxsplit=1)
+                        if len(song) == 2:
+                            artist, title = tuple(song)
+                            result = SongInfo(
+                                title=title,
+                                artist=artist
+                            )
+                        else:
+                            result = SongInfo(
+                                title=song[0]
+                            )
+                        if prev_result != result:
+                            prev_result = result
+                            yield result
+            except (aiohttp.ClientError, OSError, asyncio.IncompleteReadError, asyncio.TimeoutError) as e:
+                if not connected:
+                    raise
+                log.warning(f'Lost icy stream {self.stream_url} ({e!r}), reconnecting')
+            await asyncio.sleep(ICY_RECONNECT_SECONDS)
 
 class _RadioApiNowPlaying(BaseModel):
     name: str
@@ -201,38 +409,109 @@ class RadioApi(Stream):
     """As used by Rova"""
 
     async def read_song_info(self) -> AsyncGenerator[SongInfo, None]:
-        async with aiohttp.ClientSession() as http:
-            prev = {}
-            while True:
-                async with http.get(self.stream_url) as response:
-                    resp_data = await response.json()
-                    data = {}
-                    try:
-                        data = _RadioApi(**resp_data)
-                    except pydantic.error_wrappers.ValidationError:
-                        raise FormatError('Not a RadioApi stream')
-                    nowPlaying = data.nowPlaying[0]
-                    data_dict = nowPlaying.dict()
-                    if data_dict != prev:
-                        prev = data_dict
-                        info = SongInfo(
-                            title=nowPlaying.name,
-                            artist=nowPlaying.artist
-                        )
-                        yield info
-                await asyncio.sleep(120)
-
-
-async def read_song_info(url: str):
-    for stream_class in [M3u8, Icy, RadioApi]:
-        stream: Stream = stream_class(url)
-        try:
-            async for song_info in stream.read_song_info():
-                yield song_info
-            return
-        except FormatError:
-            pass
-    raise FormatError(f'No compatible parser found for {url}')
+        http = http_session()
+        prev = {}
+        while True:
+            async with self.schedule.slot():
+                body = await self._poll(http)
+            changed = False
+            if body is not None:
+                self.stats.parses += 1
+                try:
+                    data = _RadioApi(**json.loads(body))
+                except (ValueError, pydantic.error_wrappers.ValidationError):
+                    raise FormatError('Not a RadioApi stream')
+                nowPlaying = data.nowPlaying[0]
+                data_dict = nowPlaying.dict()
+                if data_dict != prev:
+                    prev = data_dict
+                    changed = True
+                    info = SongInfo(
+                        title=nowPlaying.name,
+                        artist=nowPlaying.artist
+                    )
+                    yield info
+            await self.schedule.wait(changed)
+
+
+PARSERS: dict[str, Type[Stream]] = {
+    'm3u8': M3u8,
+    'icy': Icy,
+    'radioapi': RadioApi,
+}
+# a known parser is given up on after this many format errors in a row
+FORMAT_RETRIES = 3
+FORMAT_RETRY_SECONDS = 30
+
+async def detect_format(url: str, stats: StreamStats | None = None) -> str | None:
+    """Name of the parser for url, going by its headers and first bytes"""
+    if stats:
+        stats.requests += 1
+    try:
+        async with http_session().get(url, headers={ 'Icy-MetaData': '1' }) as response:
+            if 'icy-metaint' in response.headers:
+                return 'icy'
+            content_type = response.headers.get('Content-Type', '').lower()
+            start = (await response.content.read(64)).lstrip()
+    except aiohttp.ClientResponseError as e:
+        if _is_icy_status(e):
+            return 'icy'
+        raise
+    if 'mpegurl' in content_type or start.startswith(M3U8_MAGIC):
+        return 'm3u8'
+    if 'json' in content_type or start.startswith(b'{'):
+        return 'radioapi'
+    return None
+
+async def read_song_info(
+    url: str,
+    stats: StreamStats | None = None,
+    schedule: PollSchedule | None = None,
+    parser: str | None = None,
+    detected: str | None = None,
+    on_detect: Callable[[str], Awaitable[None]] | None = None
+):
+    """Reads with parser if given, otherwise the previously detected parser,
+    otherwise detects one - trying it first, then each of the others in turn.
+    on_detect is called once a newly detected parser has read something.
+    A detected parser that keeps failing is detected again."""
+    name = parser or detected
+    failures = 0
+    while True:
+        if name:
+            candidates = [name]
+        else:
+            # Detection can be fooled (e.g. HLS served as audio/mpeg), so it 
+            # only decides what's tried first
+            found = await detect_format(url, stats)
+            candidates = ([found] if found else []) + [ p for p in PARSERS if p != found ]
+        for candidate in candidates:
+            stream = PARSERS[candidate](url, stats, schedule)
+            try:
+                async for song_info in stream.read_song_info():
+                    failures = 0
+                    if candidate != name:
+                        name = candidate
+                        if on_detect:
+                            await on_detect(name)
+                    yield song_info
+                return
+            except FormatError as e:
+                STREAM_FORMAT_ERRORS.inc(candidate)
+                log.debug(f'{url} is not {candidate}: {e}')
+        if not name:
+            raise FormatError(f'No compatible parser found for {url}')
+
+        failures += 1
+        if failures >= FORMAT_RETRIES:
+            if parser:
+                raise FormatError(f'{url} is not a {parser} stream')
+            log.warning(f'{url} failed as {name} {failures} times, detecting its format again')
+            name = None
+            failures = 0
+        else:
+            log.warning(f'{url} failed as {name}, retrying')
+        await asyncio.sleep(FORMAT_RETRY_SECONDS)
     
 
 if __name__ == "__main__":
@@ -0,0 +1,42 @@
+import asyncio
+import os
+
+import pytest
+from sqlalchemy import BigInteger
+from sqlalchemy.ext.compiler import compiles
+
+# radio_db.config reads these when it's imported, but no test uses them
+for name in [ 'RDB_DATABASE_CONNECTION_STRING', 'RDB_SPOTIFY_CLIENT_ID', 'RDB_SPOTIFY_CLIENT_SECRET', 'RDB_SPOTIFY_AUTH_SEED' ]:
+    os.environ.setdefault(name, '')
+
+from radio_db.db import RadioDatabase
+
+
+# SQLite only generates ids for an INTEGER PRIMARY KEY, which BIGINT isn't
+@compiles(BigInteger, 'sqlite')
+def _sqlite_big_integer(type_, compiler, **kw):
+    return 'INTEGER'
+
+
+@pytest.fixture
+def sqlite_db(tmp_path) -> RadioDatabase:
+    """A RadioDatabase on a new SQLite file with every table created. Dispose
+    of its engine at the end of the test's event loop."""
+    rdb = RadioDatabase(f'sqlite+aiosqlite:///{tmp_path / "radio_db.sqlite"}')
+
+    async def create():
+        await rdb.create_all()
+        # Its connections belong to this event loop, not the test's
+        await rdb._engine.dispose()
+
+    asyncio.run(create())
+    return rdb
+
+
+@pytest.fixture
+def postgres_url() -> str:
+    """RDB_TEST_POSTGRES, a Postgres database whose tables can be dropped and recreated"""
+    url = os.environ.get('RDB_TEST_POSTGRES')
+    if not url:
+        pytest.skip('RDB_TEST_POSTGRES is not set')
+    return url
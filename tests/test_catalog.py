@@ -0,0 +1,65 @@
+import asyncio
+import json
+from pathlib import Path
+
+from sqlalchemy import select
+
+from radio_db.catalog import import_catalog, read_catalog
+from radio_db.db import RadioDatabase, Song
+from radio_db.songs import normalise, song_key
+
+CSV = '''artist,title,spotify_uri
+Lorde,Royals,spotify:track:royals
+Lorde,Team,spotify:track:team
+Lorde,Team,spotify:track:team
+LORDE,Royals!,spotify:track:royals-again
+Someone Else,Different,spotify:track:existing
+Lorde,Green Light,spotify:track:green
+Lorde,,spotify:track:untitled
+Lorde,Ribs,
+'''
+
+JSONL = [
+    { 'artist': 'Lorde', 'title': 'Ribs', 'spotify_uri': None },
+    { 'artist': 'Lorde', 'title': 'Ribs' },
+    { 'artist': 'Lorde', 'title': 'Solar Power', 'spotify_uri': 'spotify:track:solar' },
+]
+
+
+def key(artist: str, title: str) -> int:
+    return song_key(normalise(artist, title))[0] # type: ignore
+
+
+def test_import_counts_inserted_skipped_and_rejected(sqlite_db: RadioDatabase, tmp_path: Path):
+    csv_path = tmp_path / 'catalog.csv'
+    csv_path.write_text(CSV, encoding='utf-8')
+    jsonl_path = tmp_path / 'catalog.jsonl'
+    jsonl_path.write_text('\n'.join(json.dumps(row) for row in JSONL) + '\n\n', encoding='utf-8')
+
+    async def run():
+        try:
+            async with sqlite_db.session():
+                async with sqlite_db.transaction():
+                    # Already matched: by spotify_uri, and by artist and title
+                    # (keyed on how a station spelled it)
+                    await sqlite_db.add(Song(key=1, artist='Existing', title='Song', spotify_uri='spotify:track:existing'))
+                    await sqlite_db.add(Song(key=2, artist='Lorde', title='Green Light', spotify_uri='spotify:track:green-light'))
+            counts = [
+                await import_catalog(sqlite_db, read_catalog(csv_path), batch_size=2),
+                await import_catalog(sqlite_db, read_catalog(jsonl_path), batch_size=2),
+            ]
+            async with sqlite_db.session():
+                songs = [ (s.key, s.artist, s.title, s.spotify_uri) for s in await sqlite_db.query(select(Song).order_by(Song.id)) ]
+            return counts, songs
+        finally:
+            await sqlite_db._engine.dispose()
+
+    counts, songs = asyncio.run(run())
+    # Skipped: Team again, Royals! (key), Different (spotify_uri),
+    # Green Light (artist and title). Rejected: no title, no spotify_uri
+    assert counts == [ (2, 4, 2), (1, 0, 2) ]
+    assert songs[2:] == [
+        (key('Lorde', 'Royals'), 'Lorde', 'Royals', 'spotify:track:royals'),
+        (key('Lorde', 'Team'), 'Lorde', 'Team', 'spotify:track:team'),
+        (key('Lorde', 'Solar Power'), 'Lorde', 'Solar Power', 'spotify:track:solar'),
+    ]
@@ -0,0 +1,155 @@
+"""PendingWakeup's LISTEN/NOTIFY between processes. Needs a Postgres database
+whose tables can be dropped and recreated:
+
+    RDB_TEST_POSTGRES=postgresql+asyncpg://user@localhost/radio_db_test pytest tests/test_ingest.py
+
+Each RadioDatabase has its own engine, so they stand in for separate processes.
+"""
+import asyncio
+import os
+from datetime import datetime
+from typing import List
+
+import pytest
+from sqlalchemy import make_url, select, text
+
+from radio_db import ingest
+from radio_db.db import Base, RadioDatabase, Station
+from radio_db.ingest import PendingBuffer, PendingWakeup
+
+POSTGRES = os.environ.get('RDB_TEST_POSTGRES')
+
+pytestmark = pytest.mark.skipif(not POSTGRES, reason='RDB_TEST_POSTGRES is not set')
+
+
+async def database() -> RadioDatabase:
+    rdb = RadioDatabase(POSTGRES) # type: ignore
+    await rdb.connect()
+    return rdb
+
+
+async def until(condition, timeout: float = 5):
+    async def poll():
+        while not condition():
+            await asyncio.sleep(0.01)
+    await asyncio.wait_for(poll(), timeout)
+
+
+async def woken(wakeup: PendingWakeup, timeout: float = 2) -> bool:
+    try:
+        await asyncio.wait_for(wakeup._event.wait(), timeout)
+        return True
+    except asyncio.TimeoutError:
+        return False
+
+
+def test_notified_of_other_processes_rows(monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr(ingest, 'LISTEN_RETRY_SECONDS', 0.1)
+
+    async def run():
+        listener = await database()
+        writer = await database()
+        async with writer._engine.begin() as connection:
+            await connection.run_sync(Base.metadata.drop_all)
+            await connection.run_sync(Base.metadata.create_all)
+        async with writer.session():
+            async with writer.transaction():
+                await writer.add(Station(key='a', name='A', url='u'))
+            station = await writer.first(select(Station.id))
+
+        wakeup = PendingWakeup(listener)
+        buffer = PendingBuffer(writer, 100, 5.0, PendingWakeup(writer))
+        listen = asyncio.create_task(wakeup.listen())
+        try:
+            await until(lambda: wakeup.listening)
+            wakeup.clear()
+            assert not await woken(wakeup, 0.2)
+
+            buffer.add(artist='a', title='t', seen_at=datetime.now(), station=station)
+            await buffer.flush()
+            assert await woken(wakeup)
+
+            # Losing the connection wakes waiters to poll, then it listens again
+            wakeup.clear()
+            async with writer.session():
+                terminated = await writer.exec(text(
+                    "SELECT pg_terminate_backend(pid) FROM pg_stat_activity WHERE query LIKE 'LISTEN %'"
+                ))
+                assert terminated.scalars().all() == [ True ]
+            assert await woken(wakeup)
+            await until(lambda: not wakeup.listening)
+            await until(lambda: wakeup.listening)
+
+            wakeup.clear()
+            buffer.add(artist='a', title='t2', seen_at=datetime.now(), station=station)
+            await buffer.flush()
+            assert await woken(wakeup)
+        finally:
+            listen.cancel()
+            await asyncio.gather(listen, return_exceptions=True)
+            await listener._engine.dispose()
+            await writer._engine.dispose()
+
+    asyncio.run(run())
+
+
+class Proxy:
+    """Forwards connections to Postgres. Once dropped, those connections go
+    silent both ways without being closed, like a dead network - new ones
+    still get through."""
+
+    def __init__(self, host: str, port: int):
+        self.host = host
+        self.port = port
+        self._live: List[asyncio.Event] = []
+
+    async def start(self) -> int:
+        self.server = await asyncio.start_server(self._handle, '127.0.0.1', 0)
+        return self.server.sockets[0].getsockname()[1]
+
+    def drop(self):
+        for dropped in self._live:
+            dropped.set()
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        dropped = asyncio.Event()
+        self._live.append(dropped)
+        upstream_reader, upstream_writer = await asyncio.open_connection(self.host, self.port)
+
+        async def pipe(source: asyncio.StreamReader, sink: asyncio.StreamWriter):
+            while data := await source.read(65536):
+                if not dropped.is_set():
+                    sink.write(data)
+                    await sink.drain()
+        try:
+            await asyncio.gather(pipe(reader, upstream_writer), pipe(upstream_reader, writer), return_exceptions=True)
+        finally:
+            writer.close()
+            upstream_writer.close()
+
+
+def test_silent_connection_is_replaced(monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr(ingest, 'LISTEN_RETRY_SECONDS', 0.1)
+    monkeypatch.setattr(ingest, 'LISTEN_CHECK_SECONDS', 0.2)
+
+    async def run():
+        url = make_url(POSTGRES) # type: ignore
+        proxy = Proxy(url.host or 'localhost', url.port or 5432)
+        listener = RadioDatabase(url.set(host='127.0.0.1', port=await proxy.start()).render_as_string(hide_password=False))
+        await listener.connect()
+        wakeup = PendingWakeup(listener)
+        listen = asyncio.create_task(wakeup.listen())
+        try:
+            await until(lambda: wakeup.listening)
+            wakeup.clear()
+            proxy.drop()
+            await until(lambda: not wakeup.listening)
+            assert await woken(wakeup, 0.1)
+            await until(lambda: wakeup.listening)
+        finally:
+            listen.cancel()
+            await asyncio.gather(listen, return_exceptions=True)
+            await listener._engine.dispose()
+            proxy.server.close()
+
+    asyncio.run(run())
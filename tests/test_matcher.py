@@ -0,0 +1,99 @@
+import asyncio
+from datetime import date, datetime, time, timedelta
+
+from radio_db.db import PlayDaily, RadioDatabase, Song, Station
+from radio_db.matcher import Matcher, SongCache, SongIndex, SongRef
+from radio_db.songs import normalise, song_key
+
+
+def key_input(artist: str, title: str) -> str:
+    return song_key(normalise(artist, title))[1] # type: ignore
+
+
+def index_of(*songs: tuple[str, str], size: int = 100) -> SongIndex:
+    index = SongIndex(size)
+    for i, (artist, title) in enumerate(songs, 1):
+        index.add(SongRef(i, f'spotify:track:{i}'), artist, title)
+    return index
+
+
+def matched(index: SongIndex, artist: str, title: str, threshold: float = 0.8) -> int | None:
+    match = index.match(key_input(artist, title), threshold)
+    return match[0].id if match else None
+
+
+def test_matches_near_spellings():
+    index = index_of(('Dua Lipa', 'Levitating feat. DaBaby'), ('Lorde', 'Royals'), ('Dua Lipa', 'Physical'))
+    assert matched(index, 'Dua Lipa', 'Levitating ft DaBaby') == 1
+    assert matched(index, 'Dua Lipa', 'Levitating (feat. Da Baby)') == 1
+    assert matched(index, 'Lorde', 'Royals!') == 2
+    assert matched(index, 'Lorde', 'Team') is None
+    assert matched(index, 'Dua Lipa', 'Levitating') is None
+
+
+def test_score_is_shared_over_total_trigrams():
+    index = index_of(('Lorde', 'Royals'))
+    match = index.match(key_input('Lorde', 'Royal'), 0)
+    assert match
+    # Of the 14 trigrams, Royal lacks "als" and "ls " and only it has "al "
+    assert match[1] == 11 / 14
+    assert index.match(key_input('Lorde', 'Royal'), 0.8) is None
+
+
+def test_never_matches_a_different_recording():
+    index = index_of(('Oasis', 'Wonderwall'), ('Oasis', 'Wonderwall (Live)'))
+    assert matched(index, 'Oasis', 'Wonderwall - Live') == 2
+    assert matched(index, 'Oasis', 'Wonderwal') == 1
+    assert matched(index, 'Oasis', 'Wonderwall - Radio Edit', 0.5) is None
+    assert matched(index, 'Oasis', 'Wonderwall (Acoustic)', 0.5) is None
+    # The words only count when one side has them
+    index = index_of(('Oasis', 'Live Forever'))
+    assert matched(index, 'Oasis', 'Live Forever!') == 1
+
+
+def test_forgets_the_least_recently_matched():
+    index = index_of(('A', 'One'), ('B', 'Two'), size=2)
+    assert matched(index, 'A', 'One') == 1
+    index.add(SongRef(3, None), 'C', 'Three')
+    assert len(index) == 2
+    assert 2 not in index
+    assert matched(index, 'B', 'Two') is None
+
+    index.touch(3)
+    index.add(SongRef(4, None), 'D', 'Four')
+    assert 1 not in index and 3 in index
+    # Nothing's left behind for what it forgot
+    assert all(ids <= { 3, 4 } for ids in index._postings.values())
+
+
+def test_loads_the_most_recently_played(sqlite_db: RadioDatabase):
+    today = date.today()
+
+    async def run():
+        try:
+            async with sqlite_db.session():
+                station = Station(key='a', name='A', url='u')
+                songs = [ Song(key=i, artist='Artist', title=title, spotify_uri=f'spotify:track:{i}') for i, title in enumerate([ 'One', 'Two', 'Three', 'Four' ]) ]
+                async with sqlite_db.transaction():
+                    for item in [ station, *songs ]:
+                        await sqlite_db.add(item)
+                async with sqlite_db.transaction():
+                    # Four was last played before the index's window
+                    for song, days_ago in zip(songs, [ 3, 1, 2, 40 ]):
+                        day = today - timedelta(days=days_ago)
+                        await sqlite_db.add(PlayDaily(station=station.id, song=song.id, day=day, count=1, last_played=datetime.combine(day, time(12))))
+                    # Ordered by when songs were last played, so One's more plays earlier don't count
+                    day = today - timedelta(days=20)
+                    await sqlite_db.add(PlayDaily(station=station.id, song=songs[0].id, day=day, count=5, last_played=datetime.combine(day, time(12))))
+
+                index = SongIndex(2)
+                matcher = Matcher(sqlite_db, None, [], SongCache(0, 0), timedelta(days=1), index) # type: ignore
+                await matcher.load_index(datetime.now() - timedelta(days=30))
+            return [ id for id, _ in index._songs.items() ], [ s.id for s in songs ]
+        finally:
+            await sqlite_db._engine.dispose()
+
+    indexed, (one, two, three, _) = asyncio.run(run())
+    # Least recently played first, so it's the first to be forgotten
+    assert indexed == [ three, two ]
+    assert one not in indexed
@@ -0,0 +1,206 @@
+import asyncio
+from datetime import datetime, timedelta
+from typing import List
+
+import pytest
+from sqlalchemy import func, insert, select
+
+from radio_db import metrics, monitor, stream
+from radio_db.config import StationConfig
+from radio_db.db import Base, Pending, Play, RadioDatabase, Song, Station
+from radio_db.ingest import PendingBuffer
+from radio_db.matcher import SongRef
+from radio_db.monitor import (CLAIM_TIMEOUT, PENDING_OLDEST_AGE, PENDING_ROWS, _claim_pending, _complete_pending,
+                               _measure_backlog, monitor_station)
+from radio_db.scheduler import PollScheduler
+
+
+async def seed(rdb: RadioDatabase, pending: int) -> SongRef:
+    """A station, a song, and pending rows seen a second apart on the station"""
+    async with rdb.session():
+        station = Station(key='a', name='A', url='u')
+        song = Song(key=1, artist='a', title='t', spotify_uri='spotify:track:1')
+        async with rdb.transaction():
+            await rdb.add(station)
+            await rdb.add(song)
+        start = datetime.now() - timedelta(hours=1)
+        if pending:
+            async with rdb.transaction():
+                await rdb.exec(insert(Pending).values([
+                    dict(station=station.id, artist='a', title='t', seen_at=start + timedelta(seconds=i))
+                    for i in range(pending)
+                ]))
+    return SongRef.from_song(song)
+
+
+async def count(rdb: RadioDatabase, table: type[Base]) -> int:
+    async with rdb.session():
+        return await rdb.first(select(func.count()).select_from(table))
+
+
+async def claim_concurrently(rdb: RadioDatabase, claimers: int, batch_size: int) -> List[List[int]]:
+    """Have claimers, each in its own task and session, claim until there's nothing left"""
+    async def claimer() -> List[int]:
+        ids = []
+        async with rdb.session():
+            while claimed := await _claim_pending(rdb, batch_size, [ 'a' ]):
+                ids.extend(p.id for p in claimed)
+                await asyncio.sleep(0)
+        return ids
+    return await asyncio.gather(*[ claimer() for _ in range(claimers) ])
+
+
+def test_concurrent_claimers_never_share_a_row(sqlite_db: RadioDatabase):
+    async def run():
+        try:
+            await seed(sqlite_db, 200)
+            claims = await claim_concurrently(sqlite_db, 5, 7)
+        finally:
+            await sqlite_db._engine.dispose()
+        return claims
+
+    claims = asyncio.run(run())
+    ids = [ id for claim in claims for id in claim ]
+    assert sorted(ids) == list(range(1, 201))
+
+
+def test_concurrent_claimers_skip_locked_rows(postgres_url: str):
+    async def run():
+        rdb = RadioDatabase(postgres_url)
+        await rdb.connect()
+        try:
+            async with rdb._engine.begin() as connection:
+                await connection.run_sync(Base.metadata.drop_all)
+                await connection.run_sync(Base.metadata.create_all)
+            await seed(rdb, 500)
+            async with rdb.session():
+                expected = sorted(await rdb.query(select(Pending.id)))
+            return expected, await claim_concurrently(rdb, 8, 5)
+        finally:
+            await rdb._engine.dispose()
+
+    expected, claims = asyncio.run(run())
+    ids = [ id for claim in claims for id in claim ]
+    assert sorted(ids) == expected
+    # Each got a share, rather than waiting on the others' locks
+    assert all(claims)
+
+
+def test_claims_oldest_first_and_only_unowned_or_stale_rows(sqlite_db: RadioDatabase):
+    async def run():
+        try:
+            await seed(sqlite_db, 4)
+            async with sqlite_db.session():
+                now = datetime.now()
+                async with sqlite_db.transaction():
+                    for id, picked_at in [ (2, now - timedelta(seconds=10)), (3, now - CLAIM_TIMEOUT - timedelta(seconds=1)) ]:
+                        pending = await sqlite_db.first(select(Pending).where(Pending.id == id))
+                        pending.picked_at = picked_at
+                claimed = await _claim_pending(sqlite_db, 10, [ 'a' ])
+                return [ (p.id, p.picked_at >= now) for p in claimed ]
+        finally:
+            await sqlite_db._engine.dispose()
+
+    assert asyncio.run(run()) == [ (1, True), (3, True), (4, True) ]
+
+
+def test_completing_a_reclaimed_row_does_nothing(sqlite_db: RadioDatabase, monkeypatch: pytest.MonkeyPatch):
+    class LongAgo(datetime):
+        @classmethod
+        def now(cls, tz=None):
+            return datetime.now(tz) - CLAIM_TIMEOUT - timedelta(minutes=1)
+
+    async def run():
+        try:
+            song = await seed(sqlite_db, 1)
+            with monkeypatch.context() as m:
+                m.setattr(monitor, 'datetime', LongAgo)
+                async with sqlite_db.session():
+                    first = await _claim_pending(sqlite_db, 10, [ 'a' ])
+            # It's timed out, so another claimer takes it
+            async with sqlite_db.session():
+                second = await _claim_pending(sqlite_db, 10, [ 'a' ])
+            assert [ p.id for p in first ] == [ p.id for p in second ] == [ 1 ]
+
+            async with sqlite_db.session():
+                await _complete_pending(sqlite_db, [ (first[0], song) ])
+            assert await count(sqlite_db, Pending) == 1
+            assert await count(sqlite_db, Play) == 0
+
+            async with sqlite_db.session():
+                await _complete_pending(sqlite_db, [ (second[0], song) ])
+            assert await count(sqlite_db, Pending) == 0
+            assert await count(sqlite_db, Play) == 1
+        finally:
+            await sqlite_db._engine.dispose()
+
+    asyncio.run(run())
+
+
+def test_only_claims_configured_stations(sqlite_db: RadioDatabase):
+    async def run():
+        try:
+            await seed(sqlite_db, 2)
+            async with sqlite_db.session():
+                other = Station(key='b', name='B', url='u')
+                async with sqlite_db.transaction():
+                    await sqlite_db.add(other)
+                async with sqlite_db.transaction():
+                    await sqlite_db.exec(insert(Pending).values(station=other.id, artist='b', title='t', seen_at=datetime.now()))
+                claimed = await _claim_pending(sqlite_db, 10, [ 'a', 'unregistered' ])
+                return [ p.id for p in claimed ], [ p.id for p in await _claim_pending(sqlite_db, 10, [ 'b' ]) ]
+        finally:
+            await sqlite_db._engine.dispose()
+
+    assert asyncio.run(run()) == ([ 1, 2 ], [ 3 ])
+
+
+def test_monitoring_a_station_only_holds_a_connection_to_write(sqlite_db: RadioDatabase, monkeypatch: pytest.MonkeyPatch):
+    checked_out: List[int] = []
+
+    async def read_song_info(url, stats, schedule, parser=None, detected=None, on_detect=None):
+        checked_out.append(sqlite_db._engine.pool.checkedout())
+        await on_detect('icy')
+        for title in [ 'one', 'one', 'two' ]:
+            checked_out.append(sqlite_db._engine.pool.checkedout())
+            yield stream.SongInfo(title=title, artist='a')
+    monkeypatch.setattr(stream, 'read_song_info', read_song_info)
+
+    async def run():
+        try:
+            buffer = PendingBuffer(sqlite_db, 100, 5.0)
+            await monitor_station(sqlite_db, buffer, PollScheduler(), StationConfig(key='a', name='A', url='u'))
+            async with sqlite_db.session():
+                parser = await sqlite_db.first(select(Station.parser))
+            return [ row['title'] for row in buffer._rows ], parser
+        finally:
+            await sqlite_db._engine.dispose()
+
+    assert asyncio.run(run()) == ([ 'one', 'two' ], 'icy')
+    assert checked_out == [ 0, 0, 0, 0 ]
+
+
+def test_backlog_is_measured_from_the_pending_table(sqlite_db: RadioDatabase, monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr(metrics, '_enabled', True)
+    monkeypatch.setattr(PENDING_ROWS, '_values', {})
+    monkeypatch.setattr(PENDING_OLDEST_AGE, '_values', {})
+
+    async def run():
+        try:
+            async with sqlite_db.session():
+                await _measure_backlog(sqlite_db)
+                empty = (PENDING_ROWS._values[()], PENDING_OLDEST_AGE._values[()])
+            # Claimed or not, they're waiting
+            await seed(sqlite_db, 3)
+            async with sqlite_db.session():
+                await _claim_pending(sqlite_db, 1, [ 'a' ])
+                await _measure_backlog(sqlite_db)
+            return empty
+        finally:
+            await sqlite_db._engine.dispose()
+
+    assert asyncio.run(run()) == (0, 0)
+    assert PENDING_ROWS._values[()] == 3
+    # The oldest was seen an hour ago
+    assert 3600 <= PENDING_OLDEST_AGE._values[()] < 3660
+    assert 'radio_db_pending_rows 3' in metrics.render()
@@ -0,0 +1,165 @@
+import asyncio
+import random
+from typing import Any, List, Tuple
+
+from aiohttp import web
+from sqlalchemy import select
+
+from radio_db.config import PlaylistType
+from radio_db.db import Playlist, RadioDatabase, Station
+from radio_db.playlists import DIFF_EXTRA_REQUESTS, ITEMS_PER_REQUEST, plan_changes, sync_playlist
+from radio_db.spotify import SpotifyClient
+from tests.test_spotify import FakeSpotify, client
+
+
+def apply(playlist: List[str], ops: List[Tuple[Any, ...]]) -> List[str]:
+    """What Spotify makes of playlist after ops"""
+    playlist = list(playlist)
+    for op in ops:
+        if op[0] == 'remove':
+            playlist = [ uri for uri in playlist if uri not in op[1] ]
+        elif op[0] == 'move':
+            _, start, before = op
+            playlist.insert(before, playlist[start])
+            del playlist[start if start < before else start + 1]
+        else:
+            _, uris, position = op
+            assert len(uris) <= ITEMS_PER_REQUEST
+            playlist[position:position] = uris
+    return playlist
+
+
+def uris(*ids: int) -> List[str]:
+    return [ f'spotify:track:{i}' for i in ids ]
+
+
+def test_plan_nothing_for_the_same_list():
+    assert plan_changes(uris(1, 2, 3), uris(1, 2, 3)) == []
+
+
+def test_plan_removes_adds_and_moves():
+    assert plan_changes(uris(1, 2, 3, 4), uris(1, 3, 4, 5)) == [
+        ('remove', uris(2)),
+        ('add', uris(5), 3),
+    ]
+    # Only the one out of order is moved
+    assert plan_changes(uris(1, 2, 3, 4, 5), uris(2, 3, 4, 5, 1)) == [ ('move', 0, 5) ]
+    ops = plan_changes(uris(1, 2, 3), uris(3, 2, 1))
+    assert [ op[0] for op in ops ] == [ 'move', 'move' ]
+    assert apply(uris(1, 2, 3), ops) == uris(3, 2, 1)
+
+
+def test_plan_batches_removes_and_adds():
+    ops = plan_changes(uris(*range(250)), uris(*range(250, 500)))
+    assert [ (op[0], len(op[1])) for op in ops ] == [ ('remove', 100), ('remove', 100), ('remove', 50), ('add', 100), ('add', 100), ('add', 50) ]
+
+
+def test_plan_applies_to_the_new_list():
+    rng = random.Random(1)
+    for _ in range(200):
+        old = rng.sample(range(300), rng.randrange(0, 150))
+        new = rng.sample(range(300), rng.randrange(0, 150))
+        if rng.random() < 0.5:
+            # Mostly the same, as most syncs are
+            new = [ i for i in old if rng.random() < 0.9 ] + new[:rng.randrange(5)]
+            new = list(dict.fromkeys(new))
+            for _ in range(rng.randrange(4)):
+                if len(new) > 1:
+                    i, j = rng.randrange(len(new)), rng.randrange(len(new))
+                    new[i], new[j] = new[j], new[i]
+        ops = plan_changes(uris(*old), uris(*new))
+        assert apply(uris(*old), ops) == uris(*new)
+
+
+class FakePlaylist(FakeSpotify):
+    """Holds one playlist's tracks, each with the snapshot it was added in"""
+
+    def __init__(self):
+        super().__init__([])
+        self.tracks: List[Tuple[str, int]] = []
+        self.snapshot = 0
+
+    def changed(self) -> web.Response:
+        self.snapshot += 1
+        return web.json_response({ 'snapshot_id': f's{self.snapshot}' })
+
+    def edit(self, items: List[str]):
+        """Change it as someone else would"""
+        self.tracks = [ (uri, self.snapshot) for uri in items ]
+        self.snapshot += 1
+
+    @property
+    def items(self) -> List[str]:
+        return [ uri for uri, _ in self.tracks ]
+
+    async def api(self, request: web.Request):
+        self.requests.append(request)
+        if request.method == 'GET':
+            return web.json_response({ 'snapshot_id': f's{self.snapshot}' })
+        body = await request.json()
+        if 'snapshot_id' in body:
+            # Positions are of the playlist as it was after the last change
+            assert body['snapshot_id'] == f's{self.snapshot}'
+        if request.method == 'PUT' and 'uris' in body:
+            self.tracks = [ (uri, self.snapshot + 1) for uri in body['uris'] ]
+        elif request.method == 'PUT':
+            assert body['range_length'] == 1
+            start, before = body['range_start'], body['insert_before']
+            self.tracks.insert(before, self.tracks[start])
+            del self.tracks[start if start < before else start + 1]
+        elif request.method == 'POST':
+            position = body.get('position', len(self.tracks))
+            self.tracks[position:position] = [ (uri, self.snapshot + 1) for uri in body['uris'] ]
+        else:
+            removed = { t['uri'] for t in body['tracks'] }
+            self.tracks = [ t for t in self.tracks if t[0] not in removed ]
+        return self.changed()
+
+
+def test_sync_playlist(sqlite_db: RadioDatabase):
+    fake = FakePlaylist()
+    top = uris(*range(100))
+
+    async def sync(sp: SpotifyClient, items: List[str]) -> List[str]:
+        """Sync, returning the requests made"""
+        fake.requests.clear()
+        async with sqlite_db.session():
+            playlist = await sqlite_db.first(select(Playlist))
+            await sync_playlist(sqlite_db, sp, playlist, items)
+        assert fake.items == items
+        return [ request.method for request in fake.requests ]
+
+    async def run():
+        try:
+            async with sqlite_db.session():
+                station = Station(key='a', name='A', url='u')
+                async with sqlite_db.transaction():
+                    await sqlite_db.add(station)
+                async with sqlite_db.transaction():
+                    await sqlite_db.add(Playlist(station=station.id, type_=PlaylistType.Top, spotify_uri='spotify:playlist:top'))
+            async with client(fake) as sp:
+                # Nothing published yet
+                assert await sync(sp, top) == [ 'PUT' ]
+                assert await sync(sp, top) == []
+
+                # A song drops out, one comes in, and one moves up
+                changed = top[:10] + [ top[50] ] + top[10:50] + top[51:99] + uris(100)
+                assert await sync(sp, changed) == [ 'GET', 'DELETE', 'PUT', 'POST' ]
+                # Tracks that stayed weren't re-added
+                assert { snapshot for uri, snapshot in fake.tracks if uri in top } == { 1 }
+
+                # Too many changes to be worth it
+                reversed_top = changed[::-1]
+                assert len(plan_changes(changed, reversed_top)) > 1 + DIFF_EXTRA_REQUESTS
+                assert await sync(sp, reversed_top) == [ 'PUT' ]
+
+                # Changed elsewhere, so what was published can't be changed
+                fake.edit(top)
+                assert await sync(sp, reversed_top[1:]) == [ 'GET', 'PUT' ]
+
+                # Over 100 tracks
+                assert await sync(sp, uris(*range(250))) == [ 'PUT', 'POST', 'POST' ]
+        finally:
+            await sqlite_db._engine.dispose()
+
+    asyncio.run(run())
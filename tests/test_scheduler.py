@@ -0,0 +1,115 @@
+from typing import Tuple
+
+import pytest
+
+from radio_db import scheduler
+from radio_db.scheduler import BACKOFF, GAP_WEIGHT, PollSchedule, PollScheduler
+
+
+class Clock:
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch: pytest.MonkeyPatch) -> Clock:
+    clock = Clock()
+    monkeypatch.setattr(scheduler, 'monotonic', clock)
+    return clock
+
+
+def schedule(**kwargs) -> PollSchedule:
+    options = dict(min_interval=10, max_interval=300, initial_interval=60, jitter=0)
+    return PollScheduler(**{ **options, **kwargs }).schedule()
+
+
+def changes_every(s: PollSchedule, clock: Clock, *gaps: float):
+    """Report a song change, then one after each gap"""
+    s.next_delay(True)
+    for gap in gaps:
+        clock.now += gap
+        s.next_delay(True)
+
+
+def test_initial_interval_until_there_is_a_gap(clock: Clock):
+    s = schedule()
+    assert s.next_delay(False) == 60
+    assert s.next_delay(True) == 60
+    assert s.mean_gap is None
+
+
+def test_mean_gap_is_a_moving_average(clock: Clock):
+    s = schedule()
+    changes_every(s, clock, 200)
+    assert s.mean_gap == 200
+    clock.now += 100
+    s.next_delay(True)
+    assert s.mean_gap == pytest.approx(200 + GAP_WEIGHT * (100 - 200))
+
+
+def test_halves_the_time_to_the_next_change(clock: Clock):
+    s = schedule()
+    changes_every(s, clock, 200)
+    delays = []
+    for _ in range(5):
+        clock.now += delays[-1] if delays else 0
+        delays.append(s.next_delay(False))
+    # Due 200s after the last change, then closing in - but no sooner than min_interval
+    assert delays == [ 100, 50, 25, 12.5, 10 ]
+
+
+def test_backs_off_once_overdue(clock: Clock):
+    s = schedule()
+    changes_every(s, clock, 200)
+    clock.now += 201
+    delays = [ s.next_delay(False) for _ in range(12) ]
+    assert delays[:4] == pytest.approx([ 10, 10 * BACKOFF, 10 * BACKOFF ** 2, 10 * BACKOFF ** 3 ])
+    assert delays == sorted(delays)
+    assert delays[-1] == 300
+
+
+def test_a_change_ends_the_backoff(clock: Clock):
+    s = schedule()
+    changes_every(s, clock, 200)
+    clock.now += 201
+    for _ in range(5):
+        s.next_delay(False)
+    # 201s since the last change moves the mean up a little
+    assert s.next_delay(True) == pytest.approx((200 + GAP_WEIGHT) / 2)
+    clock.now += 250
+    assert s.next_delay(False) == 10
+
+
+def test_clamped_to_max_interval(clock: Clock):
+    s = schedule()
+    changes_every(s, clock, 1000)
+    assert s.next_delay(False) == 300
+
+
+def test_hint_is_jittered_down_only(clock: Clock, monkeypatch: pytest.MonkeyPatch):
+    s = schedule(jitter=0.1)
+    bounds: Tuple[float, float] = (0, 0)
+
+    def uniform(a: float, b: float) -> float:
+        nonlocal bounds
+        bounds = (a, b)
+        return a
+
+    monkeypatch.setattr(scheduler.random, 'uniform', uniform)
+    # Below min_interval, since the stream says when there'll be something new
+    assert s.next_delay(False, 5) == pytest.approx(4.5)
+    assert bounds == (0.9, 1)
+    assert s.next_delay(False, -1) == 0
+
+
+def test_jitter_either_side_of_the_delay(clock: Clock, monkeypatch: pytest.MonkeyPatch):
+    s = schedule(jitter=0.1)
+    changes_every(s, clock, 200)
+    monkeypatch.setattr(scheduler.random, 'uniform', lambda a, b: a)
+    assert s.next_delay(False) == pytest.approx(90)
+    monkeypatch.setattr(scheduler.random, 'uniform', lambda a, b: b)
+    assert s.next_delay(False) == pytest.approx(110)
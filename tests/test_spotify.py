@@ -0,0 +1,190 @@
+import asyncio
+from contextlib import asynccontextmanager
+from time import monotonic
+from typing import AsyncIterator, Callable, List
+
+import aiohttp
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from radio_db.spotify import ClientCredentials, SpotifyClient, SpotifyError
+
+
+class FakeSpotify:
+    """Serves the accounts and API endpoints, answering API requests from a
+    queue of responses and recording every request made"""
+
+    def __init__(self, responses: List[Callable[[web.Request], web.Response]]):
+        self.responses = list(responses)
+        self.tokens_issued = 0
+        self.requests: List[web.Request] = []
+        self.times: List[float] = []
+        self.app = web.Application()
+        self.app.router.add_post('/api/token', self.token)
+        self.app.router.add_route('*', '/v1/{path:.*}', self.api)
+
+    async def token(self, request: web.Request):
+        self.tokens_issued += 1
+        return web.json_response({ 'access_token': f'token{self.tokens_issued}', 'expires_in': 3600 })
+
+    async def api(self, request: web.Request):
+        self.requests.append(request)
+        self.times.append(monotonic())
+        return self.responses.pop(0)(request)
+
+
+@asynccontextmanager
+async def client(fake: FakeSpotify, **kwargs) -> AsyncIterator[SpotifyClient]:
+    server = TestServer(fake.app)
+    await server.start_server()
+    sp = SpotifyClient(
+        ClientCredentials('id', 'secret'),
+        api_url=str(server.make_url('/v1')),
+        token_url=str(server.make_url('/api/token')),
+        **kwargs
+    )
+    try:
+        yield sp
+    finally:
+        await sp.close()
+        await server.close()
+
+
+def ok(request: web.Request):
+    return web.json_response({ 'ok': True })
+
+
+def test_retry_after():
+    fake = FakeSpotify([
+        lambda _: web.Response(status=429, headers={ 'Retry-After': '1' }),
+        ok
+    ])
+
+    async def run():
+        async with client(fake) as sp:
+            return await sp.search('song')
+
+    assert asyncio.run(run()) == { 'ok': True }
+    assert len(fake.requests) == 2
+    assert fake.times[1] - fake.times[0] >= 1
+
+
+def test_refreshes_token_on_401():
+    def needs_new_token(request: web.Request):
+        if request.headers['Authorization'] == 'Bearer token1':
+            return web.Response(status=401)
+        return ok(request)
+    fake = FakeSpotify([ needs_new_token, needs_new_token ])
+
+    async def run():
+        async with client(fake) as sp:
+            return await sp.current_user()
+
+    assert asyncio.run(run()) == { 'ok': True }
+    assert fake.tokens_issued == 2
+    assert [ r.headers['Authorization'] for r in fake.requests ] == [ 'Bearer token1', 'Bearer token2' ]
+
+
+def test_backs_off_on_server_errors():
+    fake = FakeSpotify([
+        lambda _: web.Response(status=502),
+        lambda _: web.Response(status=503),
+        ok
+    ])
+
+    async def run():
+        async with client(fake, retry_backoff=0.1) as sp:
+            return await sp.search('song')
+
+    assert asyncio.run(run()) == { 'ok': True }
+    assert len(fake.requests) == 3
+    assert fake.times[1] - fake.times[0] >= 0.1
+    assert fake.times[2] - fake.times[1] >= 0.2
+
+
+def test_gives_up_on_server_errors():
+    fake = FakeSpotify([ lambda _: web.Response(status=500) ] * 3)
+
+    async def run():
+        async with client(fake, retry_backoff=0.01, max_retries=2) as sp:
+            await sp.search('song')
+
+    with pytest.raises(SpotifyError) as error:
+        asyncio.run(run())
+    assert error.value.status == 500
+    assert len(fake.requests) == 3
+
+
+def test_retries_connection_errors():
+    def hang_up(request: web.Request):
+        assert request.transport
+        request.transport.close()
+        return ok(request)
+    fake = FakeSpotify([ hang_up, hang_up, ok ])
+
+    async def run():
+        async with client(fake, retry_backoff=0.01) as sp:
+            return await sp.search('song')
+
+    assert asyncio.run(run()) == { 'ok': True }
+    assert len(fake.requests) == 3
+
+
+def test_gives_up_on_connection_errors():
+    def hang_up(request: web.Request):
+        assert request.transport
+        request.transport.close()
+        return ok(request)
+    # aiohttp itself may retry on a fresh connection, so there are spares
+    fake = FakeSpotify([ hang_up ] * 10)
+
+    async def run():
+        async with client(fake, retry_backoff=0.01, max_retries=2) as sp:
+            await sp.search('song')
+
+    with pytest.raises(aiohttp.ClientError):
+        asyncio.run(run())
+    assert len(fake.requests) >= 3
+
+
+def test_with_auth_shares_pool_and_rate_limit():
+    fake = FakeSpotify([ ok ])
+
+    async def run():
+        async with client(fake) as sp:
+            other = sp.with_auth(ClientCredentials('other', 'secret'))
+            assert other.http is sp.http
+            assert other.bucket is sp.bucket
+            result = await other.search('song')
+            # Closing it leaves the shared session open
+            await other.close()
+            assert not sp.http.closed
+            return result
+
+    assert asyncio.run(run()) == { 'ok': True }
+
+
+def test_playlist_follows_pages():
+    def page(offset: int, total: int, limit: int = 2):
+        def respond(request: web.Request):
+            items = [ { 'track': { 'uri': f'spotify:track:{i}' } } for i in range(offset, min(offset + limit, total)) ]
+            next_offset = offset + limit
+            next = str(request.url.with_path('/v1/playlists/abc/tracks').with_query(offset=next_offset, limit=limit)) if next_offset < total else None
+            tracks = { 'items': items, 'next': next }
+            return web.json_response({ 'snapshot_id': 's1', 'tracks': tracks } if offset == 0 else tracks)
+        return respond
+    fake = FakeSpotify([ page(0, 5), page(2, 5), page(4, 5) ])
+
+    async def run():
+        async with client(fake) as sp:
+            return await sp.playlist('spotify:playlist:abc')
+
+    playlist = asyncio.run(run())
+    assert playlist['snapshot_id'] == 's1'
+    assert [ item['track']['uri'] for item in playlist['tracks']['items'] ] == [ f'spotify:track:{i}' for i in range(5) ]
+    assert [ (r.path, r.query.get('offset')) for r in fake.requests ] == [
+        ('/v1/playlists/abc', None),
+        ('/v1/playlists/abc/tracks', '2'),
+        ('/v1/playlists/abc/tracks', '4'),
+    ]
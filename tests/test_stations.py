@@ -0,0 +1,74 @@
+import asyncio
+import random
+from datetime import datetime, time, timedelta
+from typing import Any, List
+
+from sqlalchemy import and_, func, select
+
+from radio_db.db import Play, RadioDatabase, Song, Station
+from radio_db.stations import get_top_songs, rebuild_play_daily, record_plays
+
+DAYS = 3
+
+
+def plays_around(station: int, songs: List[int], now: datetime) -> List[dict[str, Any]]:
+    """Plays either side of the window's start and of each midnight in it, and some recent ones"""
+    since = now - timedelta(days=DAYS)
+    times = [ since + timedelta(minutes=m) for m in (-180, -45, 45, 180) ]
+    midnight = datetime.combine(since.date() + timedelta(days=1), time.min)
+    while midnight < now:
+        times += [ midnight - timedelta(minutes=30), midnight + timedelta(minutes=30) ]
+        midnight += timedelta(days=1)
+    times += [ now - timedelta(hours=2), now - timedelta(minutes=5) ]
+    rng = random.Random(1)
+    return [
+        dict(station=station, song=rng.choice(songs), at=at + timedelta(seconds=rng.randrange(60)))
+        for at in times
+        for _ in range(rng.randrange(1, 4))
+    ]
+
+
+def test_top_songs_from_the_rollup_match_counting_plays(sqlite_db: RadioDatabase):
+    async def top(station: Station, since: datetime):
+        from_rollup = {
+            id: (count, last_played)
+            async for last_played, count, id in get_top_songs(sqlite_db, station, DAYS, 100, (Song.id,))
+        }
+        from_plays = {
+            id: (count, last_played)
+            for id, count, last_played in await sqlite_db.exec(
+                select(Play.song, func.count(), func.max(Play.at))
+                .where(and_(Play.station == station.id, Play.at > since))
+                .group_by(Play.song)
+            )
+        }
+        return from_rollup, from_plays
+
+    async def run():
+        try:
+            async with sqlite_db.session():
+                station = Station(key='a', name='A', url='u')
+                songs = [ Song(key=i, artist='a', title=f't{i}', spotify_uri=f'spotify:track:{i}') for i in range(5) ]
+                async with sqlite_db.transaction():
+                    for item in [ station, *songs ]:
+                        await sqlite_db.add(item)
+                now = datetime.now()
+                plays = plays_around(station.id, [ s.id for s in songs ], now)
+                # In batches as pending rows are completed, so the rollup is added to
+                for i in range(0, len(plays), 7):
+                    async with sqlite_db.transaction():
+                        await record_plays(sqlite_db, plays[i:i + 7])
+
+                results = [ await top(station, now - timedelta(days=DAYS)) ]
+            await rebuild_play_daily(sqlite_db)
+            async with sqlite_db.session():
+                results.append(await top(station, now - timedelta(days=DAYS)))
+            return len(plays), results
+        finally:
+            await sqlite_db._engine.dispose()
+
+    count, results = asyncio.run(run())
+    for from_rollup, from_plays in results:
+        assert from_rollup == from_plays
+        # Some plays are before the window
+        assert 0 < sum(c for c, _ in from_plays.values()) < count
@@ -0,0 +1,160 @@
+import asyncio
+from contextlib import aclosing
+from typing import List
+
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from radio_db import stream
+from radio_db.connections import close_http_session
+from radio_db.scheduler import PollScheduler
+from radio_db.stream import Icy, M3u8, SongInfo, detect_format
+
+# (line after '#EXTINF:', duration, tags)
+GOLDEN: list[tuple[str, float, dict[str, str]]] = [
+    # iHeartRadio
+    (
+        '10.005,title="Dreams",artist="Fleetwood Mac",url="song_spot=\\"M\\" MediaBaseId=\\"1000\\" itunesTrackId=\\"0\\" amgTrackId=\\"-1\\" amgArtistId=\\"0\\" TAID=\\"30071\\" TPID=\\"1077\\" cartcutId=\\"0734372001\\" amgArtworkURL=\\"http://img.example.com/dreams.jpg\\" length=\\"00:04:14\\" unsID=\\"-1\\" spotInstanceId=\\"-1\\""',
+        10.005,
+        {
+            'title': 'Dreams', 
+            'artist': 'Fleetwood Mac', 
+            'url': 'song_spot="M" MediaBaseId="1000" itunesTrackId="0" amgTrackId="-1" amgArtistId="0" TAID="30071" TPID="1077" cartcutId="0734372001" amgArtworkURL="http://img.example.com/dreams.jpg" length="00:04:14" unsID="-1" spotInstanceId="-1"'
+        }
+    ),
+    (
+        '10.005,title="Spot Block End",artist="",url="song_spot=\\"F\\" spotInstanceId=\\"-1\\" length=\\"00:00:00\\""',
+        10.005,
+        { 'title': 'Spot Block End', 'artist': '', 'url': 'song_spot="F" spotInstanceId="-1" length="00:00:00"' }
+    ),
+    # StreamOn / Triton
+    ('10.0,title="Green Light",artist="Lorde"', 10.0, { 'title': 'Green Light', 'artist': 'Lorde' }),
+    ('9.984,offset=0,title="",artist=""', 9.984, { 'offset': '', 'title': '', 'artist': '' }),
+    ('10.0,title="Don\'t Stop Me Now",artist="Queen",album="Jazz (2011 Remaster)"', 10.0, { 'title': "Don't Stop Me Now", 'artist': 'Queen', 'album': 'Jazz (2011 Remaster)' }),
+    ('10.0,title="Café del Mar",artist="Energy 52"', 10.0, { 'title': 'Café del Mar', 'artist': 'Energy 52' }),
+    ('8.0,title="Comma, In, Title",artist="Tūī"', 8.0, { 'title': 'Comma, In, Title', 'artist': 'Tūī' }),
+    ('-1,artist="A, B & C",title="Song \\"Quoted\\""', -1.0, { 'artist': 'A, B & C', 'title': 'Song "Quoted"' }),
+    # Plain HLS
+    ('10,', 10.0, { '': '' }),
+    ('10', 10.0, { '': '' }),
+    ('5.0,Station ID', 5.0, { 'Station ID': '' }),
+    # Odd ones
+    ('6.0,title="Trailing backslash \\', 6.0, { 'title': 'Trailing backslash ' }),
+    ('10,title="unterminated, still going', 10.0, { 'title': 'unterminated, still going' }),
+    ('2.0,a=1,b="x"y,c=\\,,d="e"', 2.0, { 'a': '', 'b': 'x', 'c': ',', 'd': 'e' }),
+    ('4.5, title="Leading space",artist="Spaced Out" ', 4.5, { ' title': 'Leading space', 'artist': 'Spaced Out' }),
+    ('3.0,k=v=w,x=', 3.0, { 'k': '', 'x': '' }),
+]
+
+
+@pytest.mark.parametrize('line,duration,tags', GOLDEN)
+def test_read_inf(line: str, duration: float, tags: dict[str, str]):
+    inf = M3u8('')._read_inf(line, 'https://example.com/segment.aac')
+    assert inf.duration == duration
+    assert inf.tags == tags
+
+
+METAINT = 16
+
+
+def icy_body(titles: List[str | None]) -> bytes:
+    """METAINT bytes of "audio" then a metadata block for each title,
+    or an empty block (no change) for None"""
+    body = b''
+    for title in titles:
+        body += b'\xff' * METAINT
+        if title is None:
+            body += b'\0'
+        else:
+            metadata = f"StreamTitle='{title}';StreamUrl='';".encode()
+            blocks = -(-len(metadata) // 16)
+            body += bytes([blocks]) + metadata.ljust(blocks * 16, b'\0')
+    return body
+
+
+async def serve_icy(status_line: bytes, body: bytes, piece: int = 5) -> asyncio.Server:
+    """A station that dribbles its body out a few bytes at a time, so metadata
+    is split across reads"""
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request = await reader.readuntil(b'\r\n\r\n')
+            assert b'icy-metadata: 1' in request.lower()
+            writer.write(status_line + b'\r\nicy-metaint: %d\r\nContent-Type: audio/mpeg\r\n\r\n' % METAINT)
+            for i in range(0, len(body), piece):
+                writer.write(body[i:i + piece])
+                await writer.drain()
+                await asyncio.sleep(0)
+            # Then go quiet, like a stream between songs
+            await asyncio.sleep(60)
+        finally:
+            writer.close()
+    return await asyncio.start_server(handle, '127.0.0.1', 0)
+
+
+@pytest.mark.parametrize('status_line', [ b'HTTP/1.0 200 OK', b'ICY 200 OK' ])
+def test_icy_titles(status_line: bytes):
+    titles = [ 'Fleetwood Mac - Dreams', None, None, 'Fleetwood Mac - Dreams', "Station ID", 'A - B - Don\'t Stop' ]
+    expected = [
+        SongInfo(artist='Fleetwood Mac', title='Dreams'),
+        SongInfo(title='Station ID'),
+        SongInfo(artist='A', title="B - Don't Stop"),
+    ]
+
+    async def run():
+        server = await serve_icy(status_line, icy_body(titles))
+        port = server.sockets[0].getsockname()[1]
+        icy = Icy(f'http://127.0.0.1:{port}/stream')
+        try:
+            async with aclosing(icy.read_song_info()) as songs:
+                return [ await asyncio.wait_for(songs.__anext__(), 5) for _ in expected ], icy.stats
+        finally:
+            server.close()
+            await close_http_session()
+
+    songs, stats = asyncio.run(run())
+    assert songs == expected
+    assert stats.requests == 1
+    assert stats.parses == 4
+
+
+def test_detects_icy_status_line():
+    async def run():
+        server = await serve_icy(b'ICY 200 OK', icy_body([ 'A - B' ]))
+        port = server.sockets[0].getsockname()[1]
+        try:
+            return await detect_format(f'http://127.0.0.1:{port}/')
+        finally:
+            server.close()
+            await close_http_session()
+
+    assert asyncio.run(run()) == 'icy'
+
+
+def test_falls_through_a_wrong_detection(monkeypatch: pytest.MonkeyPatch):
+    async def detect_hls(url: str, stats: stream.StreamStats | None = None):
+        return 'm3u8'
+    monkeypatch.setattr(stream, 'detect_format', detect_hls)
+
+    async def now_playing(request: web.Request):
+        return web.json_response({ 'nowPlaying': [ { 'name': 'Dreams', 'artist': 'Fleetwood Mac' } ] }, content_type='audio/mpeg')
+    app = web.Application()
+    app.router.add_get('/', now_playing)
+    detected: List[str] = []
+
+    async def on_detect(name: str):
+        detected.append(name)
+
+    async def run():
+        server = TestServer(app)
+        await server.start_server()
+        schedule = PollScheduler(start_spread=0).schedule()
+        try:
+            async with aclosing(stream.read_song_info(str(server.make_url('/')), schedule=schedule, on_detect=on_detect)) as songs:
+                return await asyncio.wait_for(songs.__anext__(), 5)
+        finally:
+            await server.close()
+            await close_http_session()
+
+    assert asyncio.run(run()) == SongInfo(artist='Fleetwood Mac', title='Dreams')
+    assert detected == [ 'radioapi' ]